@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Microbenchmark of import.py's _fmt_date against the dateutil version it replaced.
+
+Formats the dates of a synthetic chat (see import_lines.py) with both and
+checks that they agree, also on dates converter.py does not write:
+
+    python bench/fmt_date.py --messages 200000
+"""
+import argparse
+import importlib
+import json
+import pathlib
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+imp = importlib.import_module("import")
+from import_lines import synthetic_messages
+
+ODD_DATES = ["", None, "bad", "2023-01-01 10:00:00", "2023-01-01T10:00:00+03:00", "2023-01-01T10:00:00Z",
+             "2023-01-01T10:00:00.123456", "01.02.2023 10:00", "2023-13-01T00:00:00", "0099-01-01T00:00:00",
+             "2023-01-01", "Jan 5 2023 7:05 pm", "2024-01-01T10", "2024-01-01T1005"]
+
+def dateutil_fmt_date(msg):
+    # _fmt_date before: dateutil for every date
+    from dateutil.parser import parse as parse_dt
+    try:
+        dt = parse_dt(msg.get('date', ''))
+        return dt.strftime('%d/%m/%y, %H:%M')
+    except:
+        return ''
+
+def timed(fmt, msgs):
+    t = time.perf_counter()
+    out = [fmt(m) for m in msgs]
+    return time.perf_counter() - t, out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    args = parser.parse_args()
+
+    odd = [{"date": d} for d in ODD_DATES] + [{}]
+    for m in odd:
+        assert imp._fmt_date(m) == dateutil_fmt_date(m), f"{m}: {imp._fmt_date(m)!r} != {dateutil_fmt_date(m)!r}"
+
+    msgs = list(synthetic_messages(args.messages))
+    dateutil_s, expected = timed(dateutil_fmt_date, msgs)
+    fast_s, got = timed(imp._fmt_date, msgs)
+    assert got == expected, "different dates"
+    print(json.dumps({
+        "messages": len(msgs),
+        "dateutil_s": round(dateutil_s, 3),
+        "fast_s": round(fast_s, 3),
+        "us_per_date": {"dateutil": round(dateutil_s / len(msgs) * 1e6, 2), "fast": round(fast_s / len(msgs) * 1e6, 2)},
+        "speedup": round(dateutil_s / fast_s, 1),
+        "odd_dates_checked": len(odd),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Time and disk I/O of building the import text from an export, with and without JSON in between.
+
+    classic  converter.py --stream --result (messages*.json, then result.json),
+             then import.py reading result.json: three scripts, the chat
+             written and parsed as JSON twice
+    fused    import.py --html: the html parsed straight into the import text,
+             in page order as with --stream
+
+Each step runs in its own process; its I/O is that of /proc/self/io (all
+bytes read and written, page cache or not). The html files are copied to
+a temporary folder (the media are linked), so the export is not touched.
+Both must give the same text and media list:
+
+    python bench/fused_import.py --path /path/to/export
+
+Without --path, a synthetic export (see make_export.py) is used, where
+some replies and pins quote a later message.
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import pathlib
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+def proc_io():
+    with open("/proc/self/io") as f:
+        return {k: int(v) for k, v in (line.split(": ") for line in f)}
+
+def step(export: pathlib.Path, name: str, args):
+    # Runs in its own process, prints {seconds, read, written[, text and media hashes]}
+    t = time.perf_counter()
+    result = {}
+    if name == "convert":
+        sys.argv = ["converter.py", "--path", str(export), "--chat_id", "1", "--full", "--result", "--stream",
+                    "--format", args.format, "--parser", args.parser]
+        runpy.run_path(str(ROOT / "converter.py"), run_name="__main__")
+    else:
+        imp = importlib.import_module("import")
+        with tempfile.TemporaryFile("w+t", encoding="utf-8") as out:
+            if name == "import":
+                _, files = imp.prepare_chat(export, out=out)
+            else:
+                _, files = imp.prepare_html_chat(export, out=out, parser=args.parser)
+            out.seek(0)
+            result["text_hash"] = hashlib.blake2b(out.read().encode(), digest_size=16).hexdigest()
+        result["files_hash"] = hashlib.blake2b(json.dumps(files, sort_keys=True).encode(), digest_size=16).hexdigest()
+    io = proc_io()
+    result.update(seconds=time.perf_counter() - t, read=io["rchar"], written=io["wchar"])
+    return result
+
+def run_step(export: pathlib.Path, name: str, args):
+    r = subprocess.run([sys.executable, __file__, "--step", str(export), name, "--parser", args.parser,
+                        "--format", args.format], capture_output=True, text=True, check=True)
+    return json.loads(r.stdout.splitlines()[-1])
+
+def copy_export(src: pathlib.Path, dst: pathlib.Path):
+    for p in src.iterdir():
+        if p.suffix == ".html" or p.name == ".media_cache.sqlite":
+            shutil.copy2(p, dst / p.name)
+        elif p.is_dir():
+            (dst / p.name).symlink_to(p.resolve())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Telegram export folder (default: a synthetic one)")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages of the synthetic export")
+    parser.add_argument("--parser", choices=("html.parser", "lxml"), default="html.parser")
+    parser.add_argument("--format", choices=("pretty", "compact", "jsonl"), default="pretty",
+                        help="converter.py --format of the classic path")
+    parser.add_argument("--step", nargs=2, metavar=("EXPORT", "STEP"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        print(json.dumps(step(pathlib.Path(args.step[0]), args.step[1], args)))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        export = pathlib.Path(tmp)
+        if args.path:
+            copy_export(pathlib.Path(args.path), export)
+        else:
+            from make_export import generate, MIX
+            generate(export, 2, args.messages // 2, MIX, ahead=0.1)
+        html_mb = sum(p.stat().st_size for p in export.glob("messages*.html")) / 1e6
+        # Media probes are cached in both paths: fill the cache first
+        run_step(export, "fused", args)
+        convert = run_step(export, "convert", args)
+        json_mb = sum(p.stat().st_size for p in export.glob("*.json*")) / 1e6
+        classic = run_step(export, "import", args)
+        for p in export.glob("*.json*"):
+            p.unlink()
+        fused = run_step(export, "fused", args)
+
+    def total(*steps):
+        return {"seconds": round(sum(s["seconds"] for s in steps), 2),
+                "read_mb": round(sum(s["read"] for s in steps) / 1e6, 1),
+                "written_mb": round(sum(s["written"] for s in steps) / 1e6, 1)}
+
+    same = (classic["text_hash"], classic["files_hash"]) == (fused["text_hash"], fused["files_hash"])
+    classic_total, fused_total = total(convert, classic), total(fused)
+    print(json.dumps({
+        "html_mb": round(html_mb, 1),
+        "json_written_mb": round(json_mb, 1),
+        "classic": {"convert": total(convert), "import": total(classic), "total": classic_total},
+        "fused": fused_total,
+        "speedup": round(classic_total["seconds"] / fused_total["seconds"], 2),
+        "same_output": same,
+    }, indent=2))
+    if not same:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
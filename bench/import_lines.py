@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Memory and time of building the import text in import.py.
+
+Writes a synthetic chat (replies, pins, media, polls, ...) as result.json
+or result.jsonl, then builds the import text in a fresh process with each
+--mode and reports its peak RSS and time:
+
+    load    json.load + convert_json_to_whatsapp_format, the whole chat in memory
+    stream  prepare_chat: the file read message by message, lines written as they come
+
+Both must give the same text and media list:
+
+    python bench/import_lines.py --messages 1000000 --format jsonl
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import pathlib
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+def synthetic_messages(count: int, seed: int = 1):
+    rnd = random.Random(seed)
+    for i in range(1, count + 1):
+        date = f"2023-{1 + i * 12 // (count + 1):02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:{i * 7 % 60:02d}"
+        msg = {"id": i, "type": "message", "date": date, "date_unixtime": str(1672531200 + i * 30),
+               "from": rnd.choice(("Alice", "Bob", "Carol")), "from_id": "user1",
+               "text": " ".join(rnd.choices(WORDS, k=rnd.randint(1, 25)))}
+        kind = rnd.random()
+        if kind < 0.2 and i > 1:
+            # Mostly recent messages, sometimes one further on
+            msg["reply_to_message_id"] = max(1, i - rnd.randint(1, 50)) if rnd.random() < 0.97 else i + rnd.randint(1, 20)
+        elif kind < 0.3:
+            msg["photo"] = f"photos/photo_{i}@{date[:10]}.jpg"
+            msg["width"], msg["height"], msg["file_size"] = 1280, 960, rnd.randint(50_000, 400_000)
+        elif kind < 0.35:
+            msg["file"] = f"voice_messages/audio_{i}@{date[:10]}.ogg"
+            msg["media_type"], msg["duration_seconds"], msg["file_size"] = "voice_message", 7, rnd.randint(10_000, 200_000)
+        elif kind < 0.37:
+            msg["poll"] = {"question": "Where?", "answers": [{"text": "Here"}, {"text": "There"}]}
+        elif kind < 0.38:
+            msg["forwarded_from"] = "Some channel"
+        elif kind < 0.39:
+            msg = {"id": i, "type": "service", "date": date, "date_unixtime": msg["date_unixtime"],
+                   "actor": "Alice", "action": "pin_message", "message_id": max(1, i - rnd.randint(1, 500))}
+        elif kind < 0.395:
+            msg = {"id": i, "type": "service", "date": date, "date_unixtime": msg["date_unixtime"],
+                   "actor": "Bob", "action": "phone_call", "duration_seconds": 60, "discard_reason": "hangup"}
+        yield msg
+
+def write_chat(path: pathlib.Path, count: int, fmt: str):
+    from merge import write_chat as write
+    header = {"name": "bench", "type": "personal_chat", "id": 1}
+    write(path, header, synthetic_messages(count), "jsonl" if fmt == "jsonl" else "pretty")
+
+def build(chat_dir: pathlib.Path, mode: str, out: pathlib.Path):
+    # Runs in its own process: the peak RSS is that of one mode
+    imp = importlib.import_module("import")
+    t = time.perf_counter()
+    with out.open("w", encoding="utf-8") as f:
+        if mode == "load":
+            if imp.chat_file(chat_dir).suffix == ".jsonl":
+                with imp.chat_file(chat_dir).open(encoding="utf-8") as c:
+                    data = json.loads(c.readline())
+                    data["messages"] = [json.loads(line) for line in c if line.strip()]
+            else:
+                with imp.chat_file(chat_dir).open(encoding="utf-8") as c:
+                    data = json.load(c)
+            lines, files = imp.convert_json_to_whatsapp_format(data)
+            f.writelines(lines)
+        else:
+            _, files = imp.prepare_chat(chat_dir, out=f)
+    seconds = time.perf_counter() - t
+    digest = hashlib.blake2b(out.read_bytes(), digest_size=16).hexdigest()
+    print(json.dumps({
+        "mode": mode,
+        "seconds": round(seconds, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "text_hash": digest,
+        "files_hash": hashlib.blake2b(json.dumps(files, sort_keys=True).encode(), digest_size=16).hexdigest(),
+        "media_files": len(files),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--format", choices=("json", "jsonl"), default="json", help="result.json (indented) or result.jsonl")
+    parser.add_argument("--mode", nargs="+", choices=("load", "stream"), default=["load", "stream"])
+    parser.add_argument("--build", nargs=2, metavar=("CHAT_DIR", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build:
+        with tempfile.TemporaryDirectory() as tmp:
+            build(pathlib.Path(args.build[0]), args.build[1], pathlib.Path(tmp) / "lines.txt")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chat_dir = pathlib.Path(tmp)
+        chat = chat_dir / ("result.jsonl" if args.format == "jsonl" else "result.json")
+        write_chat(chat, args.messages, args.format)
+        chat_mb = chat.stat().st_size / 1e6
+        results = []
+        for mode in args.mode:
+            r = subprocess.run([sys.executable, __file__, "--build", str(chat_dir), mode],
+                               capture_output=True, text=True, check=True)
+            results.append(json.loads(r.stdout))
+    same = len({(r["text_hash"], r["files_hash"]) for r in results}) == 1
+    print(json.dumps({"messages": args.messages, "chat_mb": round(chat_mb, 1),
+                      "format": args.format, "same_output": same, "results": results}, indent=2))
+    if not same:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
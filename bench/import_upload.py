@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the media upload loop of import.py.
+
+A FakeClient stands in for TelegramClient: every part of an upload (split
+as Telethon does) costs one round trip plus its transfer time on the
+connection, every request one round trip. The same file list is uploaded
+with each --concurrency value, in export order and largest first (--order),
+next to import.py's estimate, and the calls the fake server received are
+checked:
+
+    python bench/import_upload.py --files 100 --latency 0.05 --concurrency 1 4 16
+    python bench/import_upload.py --path "FOLDER_WITH_result.json"
+
+--server-rate makes the fake server answer FLOOD_WAIT once more than that
+many requests per second arrive, --error-rate fails that share of the
+uploads with RPC_CALL_FAIL; the scheduler's final state is reported:
+
+    python bench/import_upload.py --concurrency 16 --server-rate 20 --flood-wait 2 --error-rate 0.02
+
+--duplicates makes that share of the synthetic files stickers with the
+same content as another one, uploaded with and without deduplication:
+
+    python bench/import_upload.py --files 300 --duplicates 0.5 --concurrency 8 --order largest
+
+--big-file uploads one sparse file of that many MB with each
+--part-parallel value (1 = part after part) and reports the rate and the
+peak memory allocated; --link caps the bytes/s of all the requests
+together:
+
+    python bench/import_upload.py --big-file 500 --link 12.5e6 --part-parallel 1 4 8 16
+
+--check-resume runs a whole import that loses its connection halfway,
+then "import.py --resume", and checks that no file is uploaded twice.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+imp = importlib.import_module("import")  # import.py
+from telethon import errors, functions, types, utils
+
+def part_size(size):
+    return utils.get_appropriated_part_size(size) * 1024
+
+class FakeClient:
+    # The part of TelegramClient used by import.py, with simulated network costs
+    def __init__(self, latency=0.05, bandwidth=4e6, fail_after=None, server_rate=0, flood_wait=2, error_rate=0,
+                 link=0):
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes/s of one request
+        self.link = link            # bytes/s of all the requests together (0 = no limit)
+        self.link_free = 0.0        # when the link is done with the parts already sent
+        self.fail_after = fail_after  # connection lost after this many imported files
+        self.server_rate = server_rate  # requests/s before FLOOD_WAIT (0 = no limit)
+        self.flood_wait = flood_wait
+        self.error_rate = error_rate  # share of uploads failing with RPC_CALL_FAIL
+        self.recent = []            # times of the requests of the last second
+        self.flood_waits = 0
+        self.errors = 0
+        self.uploaded = {}          # file id -> name
+        self.parts = {}             # file id -> SaveFilePart/SaveBigFilePart parts received
+        self.received = {}          # file id -> bytes received
+        self.imported_ids = []      # (file_name, file id) of every UploadImportedMediaRequest
+        self.imported = []          # file_name of every UploadImportedMediaRequest
+        self.requests = []          # type names of the other requests
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_entity(self, entity):
+        raise ValueError("no such channel")
+
+    def _request(self):
+        # One request reaches the server
+        if not self.server_rate:
+            return
+        now = time.monotonic()
+        self.recent = [t for t in self.recent if t > now - 1]
+        if len(self.recent) >= self.server_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_wait)
+        self.recent.append(now)
+
+    async def _transfer(self, n):
+        # One part: a round trip plus its transfer
+        now = time.monotonic()
+        seconds = n / self.bandwidth
+        if self.link:
+            self.link_free = max(now, self.link_free) + n / self.link
+            seconds = max(seconds, self.link_free - now)
+        await asyncio.sleep(self.latency + seconds)
+
+    def _fail(self):
+        if self.fail_after is not None and len(self.imported) >= self.fail_after:
+            raise ConnectionError("connection lost")
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise errors.RpcCallFailError(None)
+
+    async def upload_file(self, path, **kwargs):
+        if self.fail_after is not None and len(self.imported) >= self.fail_after:
+            raise ConnectionError("connection lost")
+        path = pathlib.Path(path)
+        size = path.stat().st_size
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            for _ in range(max(1, math.ceil(size / part_size(size)))):
+                self._request()
+                await self._transfer(min(size, part_size(size)))
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                raise errors.RpcCallFailError(None)
+        finally:
+            self.in_flight -= 1
+        file_id = random.getrandbits(62)
+        self.uploaded[file_id] = path.name
+        parts = max(1, math.ceil(size / part_size(size)))
+        if size > 10 * 1024 * 1024:
+            return types.InputFileBig(file_id, parts, path.name)
+        return types.InputFile(file_id, parts, path.name, "")
+
+    async def __call__(self, request):
+        if isinstance(request, (functions.upload.SaveFilePartRequest, functions.upload.SaveBigFilePartRequest)):
+            self._request()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await self._transfer(len(request.bytes))
+                self._fail()
+            finally:
+                self.in_flight -= 1
+            self.parts.setdefault(request.file_id, set()).add(request.file_part)
+            self.received[request.file_id] = self.received.get(request.file_id, 0) + len(request.bytes)
+            return True
+        await asyncio.sleep(self.latency)
+        if isinstance(request, functions.messages.UploadImportedMediaRequest):
+            self._request()
+            media = request.media
+            uploaded = self.uploaded.get(media.file.id)
+            if self.parts.get(media.file.id) == set(range(media.file.parts)):
+                # The same upload may be sent for files with the same content
+                uploaded = pathlib.Path(request.file_name).name
+            if uploaded != pathlib.Path(request.file_name).name:
+                raise AssertionError(f"{request.file_name} sent with the upload of {uploaded}")
+            self.imported.append(request.file_name)
+            self.imported_ids.append((request.file_name, media.file.id))
+            return None
+        self.requests.append(type(request).__name__)
+        if isinstance(request, functions.messages.InitHistoryImportRequest):
+            return types.messages.HistoryImport(id=random.getrandbits(62))
+        return None
+
+def synthetic_files(folder: pathlib.Path, count: int, seed: int = 1, duplicates: float = 0):
+    # Sparse files with export-like sizes: many photos/voices, some big videos,
+    # and a "duplicates" share of stickers, all copies of the same 10
+    rnd = random.Random(seed)
+    stickers = [rnd.randint(20_000, 60_000) for _ in range(10)] if duplicates else []
+    files = {}
+    for i in range(count):
+        kind = rnd.random()
+        if duplicates and rnd.random() < duplicates:
+            rel, size, info = f"stickers/sticker_{i}.webp", rnd.choice(stickers), {"media_type": "sticker"}
+        elif kind < 0.6:
+            rel, size, info = f"photos/photo_{i}.jpg", rnd.randint(50_000, 400_000), {"is_photo": True}
+        elif kind < 0.85:
+            rel, size, info = f"voice_messages/audio_{i}.ogg", rnd.randint(10_000, 200_000), {"media_type": "voice_message", "duration_seconds": 5}
+        elif kind < 0.97:
+            rel, size, info = f"video_files/video_{i}.mp4", rnd.randint(1_000_000, 8_000_000), {"media_type": "video_file", "duration_seconds": 30, "width": 640, "height": 360}
+        else:
+            rel, size, info = f"files/file_{i}.zip", rnd.randint(5_000_000, 30_000_000), {}
+        path = folder / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            f.truncate(size)
+        info.update(filename=path.name, file_size=size)
+        files[rel] = info
+    return files
+
+async def run(files, base_path, concurrency, latency, bandwidth, server_rate=0, flood_wait=2, error_rate=0,
+              order="largest", dedup=True):
+    client = FakeClient(latency, bandwidth, server_rate=server_rate, flood_wait=flood_wait, error_rate=error_rate)
+    planned, sizes = imp.plan_uploads(base_path, files)
+    if order == "largest":
+        files = planned
+    t = time.perf_counter()
+    copies = imp.find_duplicates(base_path, files, sizes, imp.HashCache(base_path)) if dedup else {}
+    hash_s = time.perf_counter() - t
+    copied = {rel for group in copies.values() for rel, _ in group}
+    unique = {rel: info for rel, info in files.items() if rel not in copied}
+    estimate = imp.estimate_upload_time([sizes[rel] for rel in unique], concurrency, latency, bandwidth)
+    # Start at full concurrency, as the estimate does
+    scheduler = imp.UploadScheduler(concurrency, start=concurrency)
+    t = time.perf_counter()
+    await imp.upload_all(client, "peer", 1, base_path, unique, concurrency, scheduler=scheduler, copies=copies)
+    elapsed = time.perf_counter() - t
+    assert sorted(client.imported) == sorted(info["filename"] for info in files.values()), "lost or repeated files"
+    by_name = {info["filename"]: rel for rel, info in files.items()}
+    for name, file_id in client.imported_ids:
+        assert client.received[file_id] == os.path.getsize(base_path / by_name[name]), f"{name}: wrong upload"
+    stats = scheduler.stats()
+    return {
+        "concurrency": concurrency,
+        "order": order,
+        "dedup": dedup,
+        "seconds": round(elapsed, 2),
+        "hash_s": round(hash_s, 3),
+        "uploaded_mb": round(sum(client.received.values()) / 1e6, 1),
+        "copies": len(copied),
+        "estimate_s": round(estimate, 2),
+        "files_per_s": round(len(files) / elapsed, 1),
+        "max_in_flight": client.max_in_flight,
+        "final_limit": stats["limit"],
+        "flood_waits": stats["flood_waits"],
+        "retries": stats["retries"],
+    }
+
+async def run_big(path: pathlib.Path, latency, bandwidth, link, size_kb, parallel):
+    client = FakeClient(latency, bandwidth, link=link)
+    tracemalloc.start()
+    t = time.perf_counter()
+    await imp.upload_file(client, "peer", 1, path.parent, path.name, {"filename": path.name},
+                          part_size=size_kb * 1024, part_parallel=parallel)
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert client.imported == [path.name], "file not imported"
+    return {
+        "part_parallel": parallel,
+        "seconds": round(elapsed, 2),
+        "mb_per_s": round(path.stat().st_size / elapsed / 1e6, 2),
+        "max_in_flight": client.max_in_flight,
+        "peak_alloc_mb": round(peak / 1e6, 1),
+    }
+
+def check_resume(base_path: pathlib.Path, latency: float):
+    # An import losing its connection halfway, then --resume
+    chat = {"name": "bench", "type": "personal_chat", "id": 1, "messages": [
+        {"id": i + 1, "type": "message", "date": "2024-01-01T10:00:00", "from": "A", "text": "",
+         "file": rel, **{k: v for k, v in info.items() if k not in ("filename", "is_photo")}}
+        for i, (rel, info) in enumerate(synthetic_files(base_path, 60).items())
+    ]}
+    (base_path / "result.json").write_text(json.dumps(chat), encoding="utf-8")
+    first = FakeClient(latency, fail_after=25)
+    try:
+        asyncio.run(imp.run_import(first, base_path, "@peer", concurrency=4))
+        raise AssertionError("the first run should have failed")
+    except ConnectionError:
+        pass
+    journal = (base_path / "import_journal.jsonl").read_text(encoding="utf-8").splitlines()
+    second = FakeClient(latency)
+    asyncio.run(imp.run_import(second, base_path, "@peer", concurrency=4, resume=True))
+    names = first.imported + second.imported
+    assert sorted(names) == sorted(pathlib.Path(m["file"]).name for m in chat["messages"]), "lost or repeated files"
+    assert "InitHistoryImportRequest" not in second.requests and "StartHistoryImportRequest" in second.requests
+    assert not (base_path / "import_journal.jsonl").exists()
+    return {"first_run": len(first.imported), "journaled": len(journal) - 1, "resumed": len(second.imported)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Folder with result.json: upload its media list instead of synthetic files")
+    parser.add_argument("--files", type=int, default=100, help="Number of synthetic files")
+    parser.add_argument("--duplicates", type=float, default=0, help="Share of synthetic files with the same content")
+    parser.add_argument("--latency", type=float, default=0.05, help="Round trip time in seconds")
+    parser.add_argument("--bandwidth", type=float, default=4e6, help="Bytes/s of one connection")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--order", nargs="+", choices=("export", "largest"), default=["export", "largest"],
+                        help="Upload order: as in result.json, or largest first (import.py)")
+    parser.add_argument("--server-rate", type=float, default=0, help="Requests/s the server accepts before FLOOD_WAIT (0 = no limit)")
+    parser.add_argument("--flood-wait", type=int, default=2, help="Seconds asked by a FLOOD_WAIT")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of the uploads failing with RPC_CALL_FAIL")
+    parser.add_argument("--link", type=float, default=0, help="Bytes/s of all the requests together (0 = no limit)")
+    parser.add_argument("--big-file", type=int, help="Upload one file of this many MB instead")
+    parser.add_argument("--part-size", type=int, choices=imp.PART_SIZES_KB, default=512, help="Part size in KB")
+    parser.add_argument("--part-parallel", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--check-resume", action="store_true", help="Check an interrupted then resumed import")
+    args = parser.parse_args()
+
+    if args.big_file:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "video.mp4"
+            with path.open("wb") as f:
+                f.truncate(args.big_file * 1024 * 1024)
+            results = [asyncio.run(run_big(path, args.latency, args.bandwidth, args.link, args.part_size, p))
+                       for p in args.part_parallel]
+        print(json.dumps({
+            "mb": args.big_file,
+            "part_size_kb": args.part_size,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "link": args.link,
+            "results": results,
+        }, indent=2))
+        return
+
+    if args.check_resume:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(json.dumps(check_resume(pathlib.Path(tmp), args.latency), indent=2))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.path:
+            base_path = pathlib.Path(args.path)
+            _, files = imp.prepare_chat(base_path)
+            files = {rel: info for rel, info in files.items() if (base_path / rel).exists()}
+        else:
+            base_path = pathlib.Path(tmp)
+            files = synthetic_files(base_path, args.files, duplicates=args.duplicates)
+        total = sum(os.path.getsize(base_path / rel) for rel in files)
+        results = [asyncio.run(run(files, base_path, c, args.latency, args.bandwidth,
+                                   args.server_rate, args.flood_wait, args.error_rate, order, dedup))
+                   for c in args.concurrency for order in args.order
+                   for dedup in ((False, True) if args.duplicates else (True,))]
+    print(json.dumps({
+        "files": len(files),
+        "bytes": total,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "server_rate": args.server_rate,
+        "error_rate": args.error_rate,
+        "results": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""Synthetic Telegram export: messages*.html pages and small placeholder media.
+
+The pages look like Telegram Desktop's html export (joined messages, date
+separators, pages continuing the sender of the previous one), with a given
+share of replies, forwards, pins, calls, other service messages, polls and
+media. Media are tiny files under photos/, video_files/, voice_messages/,
+stickers/, files/ and round_video_messages/; with ffmpeg (or imageio-ffmpeg)
+the videos and voice messages are real, otherwise they are placeholder bytes.
+
+    python bench/make_export.py /tmp/export --pages 20 --per-page 1000 --reply 0.2
+
+The same arguments and --seed give the same export.
+"""
+import argparse
+import html
+import pathlib
+import random
+import shutil
+import subprocess
+from datetime import datetime, timedelta
+
+NAMES = ["User1Name", "User2Name"]
+WORDS = ["hello", "world", "привет", "ok", "lol", "😀", "what", "a&b", "<x>", "test"]
+
+# Share of the messages of each kind, the rest is plain text
+MIX = {"reply": 0.13, "forward": 0.06, "pin": 0.04, "call": 0.015, "service": 0.015, "poll": 0.01,
+       "contact": 0.01, "location": 0.01, "media": 0.3}
+
+HEAD = """<!DOCTYPE html>
+<html>
+ <head>
+  <meta charset="utf-8"/>
+<title>Exported Data</title>
+ </head>
+ <body onload="CheckLocation();">
+  <div class="page_wrap">
+   <div class="page_header">
+    <div class="content">
+     <div class="text bold">
+{chat}
+     </div>
+    </div>
+   </div>
+   <div class="page_body chat_page">
+    <div class="history">
+"""
+TAIL = """    </div>
+   </div>
+  </div>
+ </body>
+</html>
+"""
+
+def find_ffmpeg():
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return shutil.which("ffmpeg")
+
+def image(path: pathlib.Path, size, mode="RGB", color=0):
+    try:
+        from PIL import Image
+    except ImportError:
+        path.write_bytes(b"\0" * 256)
+        return
+    Image.new(mode, size, color).save(path)
+
+def make_media(out: pathlib.Path, count: int, rnd: random.Random):
+    # {kind: [relative paths]}, "count" files of every kind
+    for d in ("photos", "video_files", "voice_messages", "stickers", "files", "round_video_messages"):
+        (out / d).mkdir(parents=True, exist_ok=True)
+    ffmpeg = find_ffmpeg()
+
+    def encode(path, args):
+        if ffmpeg:
+            subprocess.run([ffmpeg, "-v", "error", "-y", *args, str(path)], check=True)
+        else:
+            path.write_bytes(b"\0" * 256)
+
+    def photo(i):
+        p = out / "photos" / f"photo_{i}@01-01-2024_10-00-00.jpg"
+        image(p, (64 + i % 7, 48 + i % 5), color=(i % 255, 0, 0))
+        image(p.with_name(f"{p.stem}_thumb.jpg"), (16, 12))
+        return p
+
+    def video(i, folder="video_files", name=None):
+        p = out / folder / (name or f"video_{i}.mp4")
+        encode(p, ["-f", "lavfi", "-i", f"testsrc=size=32x24:rate=5:duration={1 + i % 3}", "-pix_fmt", "yuv420p"])
+        image(p.with_name(f"{p.name}_thumb.jpg"), (16, 12))
+        return p
+
+    def voice(i):
+        p = out / "voice_messages" / f"audio_{i}@01-01-2024_10-00-00.ogg"
+        encode(p, ["-f", "lavfi", "-i", f"sine=duration={1 + i % 4}", "-c:a", "libvorbis"])
+        return p
+
+    def sticker(i):
+        if i % 3 == 0:
+            p = out / "stickers" / f"sticker_{i}.webp"
+            image(p, (512, 512), "RGBA")
+        elif i % 3 == 1:
+            p = out / "stickers" / f"sticker_{i}.tgs"
+            p.write_bytes(b"\x1f\x8b" + bytes(64))
+        else:
+            p = out / "stickers" / f"sticker_{i}.webm"
+            encode(p, ["-f", "lavfi", "-i", "testsrc=size=64x64:rate=5:duration=1", "-c:v", "libvpx-vp9"])
+        return p
+
+    def gif(i):
+        p = out / "files" / f"anim_{i}.gif"
+        image(p, (20, 10), "P")
+        return p
+
+    def doc(i):
+        p = out / "files" / f"doc_{i}.pdf"
+        p.write_bytes(b"%PDF-1.4\n" + bytes(rnd.randint(10, 300)))
+        return p
+
+    makers = {"photo": photo, "video": video, "voice": voice, "sticker": sticker, "gif": gif, "doc": doc,
+              "round": lambda i: video(i, "round_video_messages", f"file_{i}@01-01-2024.mp4")}
+    return {kind: [make(i).relative_to(out).as_posix() for i in range(count)] for kind, make in makers.items()}
+
+def date_div(ts):
+    title = ts.strftime("%d.%m.%Y %H:%M:%S UTC+03:00")
+    return f'       <div class="pull_right date details" title="{title}">\n{ts.strftime("%H:%M")}\n       </div>\n'
+
+def message(mid, ts, sender, joined, inner):
+    cls = "message default clearfix joined" if joined else "message default clearfix"
+    out = f'     <div class="{cls}" id="message{mid}">\n'
+    if not joined:
+        out += '      <div class="pull_left userpic_wrap">\n       <div class="userpic"></div>\n      </div>\n'
+    out += '      <div class="body">\n' + date_div(ts)
+    if not joined:
+        out += f'       <div class="from_name">\n{sender}\n       </div>\n'
+    return out + inner + '      </div>\n     </div>\n'
+
+def service(mid, inner):
+    return (f'     <div class="message service" id="message{mid}">\n'
+            f'      <div class="body details">\n{inner}\n      </div>\n     </div>\n')
+
+def go_to(mid, text):
+    return f'<a href="#go_to_message{mid}" onclick="return GoToMessage({mid})">{text}</a>'
+
+def text_div(rnd):
+    t = " ".join(html.escape(rnd.choice(WORDS)) for _ in range(rnd.randint(1, 12)))
+    r = rnd.random()
+    if r < 0.1:
+        t = f'{t} <strong>{html.escape(rnd.choice(WORDS))}</strong> <em>{html.escape(rnd.choice(WORDS))}</em>'
+    elif r < 0.15:
+        t = f'<a href="https://example.com/{rnd.randint(1, 99)}">link</a> {t}'
+    elif r < 0.2:
+        t = f'{t}<br>{html.escape("<b>&amp;</b>")}'
+    return f'       <div class="text">\n{t}\n       </div>\n'
+
+def media_wrap(href, thumb=None):
+    img = f'<img class="photo" src="{thumb}"/>' if thumb else ""
+    return (f'       <div class="media_wrap clearfix">\n'
+            f'        <a class="media clearfix pull_left block_link" href="{href}">{img}</a>\n'
+            f'       </div>\n')
+
+def media_div(rnd, media):
+    # The media of Telegram exports, roughly in their usual proportions
+    kind = rnd.choices(("photo", "video", "round", "voice", "sticker", "gif", "doc", "link"),
+                       (12, 3, 2, 4, 6, 2, 3, 1))[0]
+    if kind == "link":
+        return media_wrap("https://example.com/remote.bin"), kind
+    return media_wrap(rnd.choice(media[kind])), kind
+
+def call_div(rnd):
+    status = rnd.choice(["Outgoing (12 seconds)", "Incoming (3 seconds)", "Cancelled", "Declined", "Missed", "Outgoing"])
+    return ('       <div class="media_wrap clearfix">\n        <div class="media clearfix pull_left media_call success">\n'
+            '         <div class="fill pull_left"></div>\n         <div class="body">\n'
+            '          <div class="title bold">Call</div>\n'
+            f'          <div class="status details">{status}</div>\n         </div>\n        </div>\n       </div>\n')
+
+def poll_div(rnd):
+    return ('       <div class="media_wrap clearfix">\n        <div class="media_poll">\n'
+            '         <div class="question bold">Which one?</div>\n'
+            '         <div class="answer">- Red</div>\n         <div class="answer">- Blue</div>\n'
+            f'         <div class="total details">{rnd.randint(0, 9)} votes</div>\n        </div>\n       </div>\n')
+
+CONTACT = ('       <div class="media_wrap clearfix">\n        <div class="media clearfix pull_left media_contact">\n'
+           '         <div class="body">\n          <div class="title bold">John Doe</div>\n'
+           '          <div class="status details">+100200300</div>\n         </div>\n        </div>\n       </div>\n')
+
+LOCATION = ('       <div class="media_wrap clearfix">\n'
+            '        <a class="media clearfix pull_left block_link media_location" '
+            'href="https://maps.google.com/maps?q=55.75,37.61&amp;ll=55.75,37.61&amp;z=16">'
+            '<div class="body"><div class="title bold">Location</div></div></a>\n       </div>\n')
+
+def generate(out: pathlib.Path, pages: int, per_page: int, mix: dict = MIX, media_files: int = 8, seed: int = 1,
+             chat: str = "User2Name", ahead: float = 0.0):
+    # Write the export to "out", returns the number of messages of each kind;
+    # "ahead" is the share of the replies and pins quoting a later message
+    rnd = random.Random(seed)
+    last = pages * per_page
+
+    def quoted(mid, back):
+        if ahead and mid < last and rnd.random() < ahead:
+            return rnd.randint(mid + 1, min(last, mid + 50))
+        return back
+    out.mkdir(parents=True, exist_ok=True)
+    media = make_media(out, media_files, rnd)
+    kinds, weights = list(mix), list(mix.values())
+    kinds.append("text")
+    weights.append(max(0.0, 1 - sum(weights)))
+    counts = {}
+    ts = datetime(2024, 1, 1, 9, 0, 0)
+    mid = 1
+    separator = -1
+    prev_sender = None
+    for page in range(pages):
+        parts = [HEAD.format(chat=chat)]
+        if page > 0 and rnd.random() < 0.7:
+            # Page starting with a pin, before any dated message
+            parts.append(service(mid, f'{rnd.choice(NAMES)} pinned {go_to(max(1, mid - 3), "this message")}'))
+            counts["pin"] = counts.get("pin", 0) + 1
+            mid += 1
+        for i in range(per_page):
+            ts += timedelta(seconds=rnd.randint(1, 4000))
+            if rnd.random() < 0.03:
+                parts.append(service(separator, ts.strftime("%-d %B %Y")))
+                separator -= 1
+            kind = rnd.choices(kinds, weights)[0]
+            sender = rnd.choice(NAMES)
+            joined = sender == prev_sender and rnd.random() < 0.8 and i > 0
+            if i == 0 and page > 0 and page % 2 and prev_sender:
+                # Page continuing the previous page's sender
+                sender, joined = prev_sender, True
+            if kind == "pin":
+                parts.append(service(mid, f'{sender} pinned {go_to(quoted(mid, max(1, mid - 5)), "this message")}'))
+            elif kind == "service":
+                parts.append(service(mid, rnd.choice([f"{sender} changed chat theme to 🌸", "History cleared"])))
+            else:
+                if kind == "call":
+                    inner = call_div(rnd)
+                elif kind == "poll":
+                    inner = poll_div(rnd)
+                elif kind == "contact":
+                    inner = CONTACT
+                elif kind == "location":
+                    inner = LOCATION
+                elif kind == "forward":
+                    fwd_media = media_wrap(rnd.choice(media["photo"] + media["voice"])) if rnd.random() < 0.4 else ""
+                    inner = ('       <div class="forwarded body">\n'
+                             '        <div class="from_name">\nSome Channel <span class="date details" '
+                             'title="01.01.2024 08:00:00 UTC+03:00"> 01.01.2024 08:00:00</span>\n        </div>\n'
+                             + fwd_media + text_div(rnd) + '       </div>\n')
+                elif kind == "reply" and mid > 1:
+                    rid = quoted(mid, rnd.randint(max(1, mid - 500), mid - 1))
+                    inner = (f'       <div class="reply_to details">\nIn reply to {go_to(rid, "this message")}\n'
+                             f'       </div>\n' + text_div(rnd))
+                elif kind == "media":
+                    inner, _ = media_div(rnd, media)
+                    if rnd.random() < 0.3:
+                        inner += text_div(rnd)
+                else:
+                    kind = "text"
+                    inner = text_div(rnd)
+                parts.append(message(mid, ts, sender, joined, inner))
+                prev_sender = sender
+            counts[kind] = counts.get(kind, 0) + 1
+            mid += 1
+        parts.append(TAIL)
+        name = "messages.html" if page == 0 else f"messages{page + 1}.html"
+        (out / name).write_text("".join(parts), encoding="utf-8")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Telegram html export")
+    parser.add_argument("output", help="Folder of the export (created if needed)")
+    parser.add_argument("--pages", type=int, default=3, help="Number of messages*.html pages")
+    parser.add_argument("--per-page", type=int, default=1000, help="Messages per page")
+    parser.add_argument("--media-files", type=int, default=8, help="Distinct files of every media kind")
+    parser.add_argument("--seed", type=int, default=1)
+    for kind, share in MIX.items():
+        parser.add_argument(f"--{kind}", type=float, default=share, help=f"Share of {kind} messages ({share})")
+    parser.add_argument("--ahead", type=float, default=0.0, help="Share of the replies and pins quoting a later message")
+    args = parser.parse_args()
+
+    mix = {kind: getattr(args, kind) for kind in MIX}
+    if sum(mix.values()) > 1:
+        parser.error("the shares add up to more than 1")
+    counts = generate(pathlib.Path(args.output), args.pages, args.per_page, mix, args.media_files, args.seed,
+                      ahead=args.ahead)
+    print(f"✅ {args.pages} pages, {sum(counts.values())} messages in {args.output}: "
+          + ", ".join(f"{n} {kind}" for kind, n in sorted(counts.items())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Memory of the parsed messages in converter.py, compared between source trees.
+
+For each --tree (a folder with converter.py; default: this one), in a
+fresh process on a one-page synthetic export (see make_export.py):
+
+    retained   tracemalloc size and blocks of the messages kept by
+               parse_html_to_messages, once the html tree is freed
+    peak_rss   of a full "converter.py" run (without --stream, the page
+               held in memory), and its time
+
+The outputs of every tree must be identical. To compare with the
+previous commit:
+
+    git worktree add /tmp/before HEAD~1
+    python bench/message_memory.py --messages 200000 --tree /tmp/before .
+"""
+import argparse
+import gc
+import hashlib
+import json
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "bench"))
+
+def retained(tree: pathlib.Path, export: pathlib.Path):
+    # Runs in its own process, with "tree" first on sys.path
+    sys.path.insert(0, str(tree))
+    import converter
+    converter.open_media_cache(export / ".media_cache.sqlite")
+    converter.open_media_pool(0)
+    converter.open_export_index(export)
+    html = export / "messages.html"
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    t = time.perf_counter()
+    msgs = converter.parse_html_to_messages(html, export, {})
+    seconds = time.perf_counter() - t
+    gc.collect()
+    diff = tracemalloc.take_snapshot().compare_to(before, "filename")
+    size = sum(d.size_diff for d in diff)
+    blocks = sum(d.count_diff for d in diff)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    t = time.perf_counter()
+    for msg in msgs:
+        json.dumps(converter.order_message(msg), ensure_ascii=False)
+    return {"messages": len(msgs), "retained_mb": round(size / 1e6, 1), "retained_blocks": blocks,
+            "bytes_per_message": round(size / len(msgs)), "parse_peak_mb": round(peak / 1e6, 1),
+            "parse_s": round(seconds, 2), "serialize_s": round(time.perf_counter() - t, 2)}
+
+def full_run(tree: pathlib.Path, export: pathlib.Path):
+    # Runs in its own process: its only child is this converter run
+    t = time.perf_counter()
+    subprocess.run([sys.executable, str(tree / "converter.py"), "--path", str(export), "--chat_id", "1", "--full"],
+                   check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - t
+    out = (export / "messages.json").read_bytes()
+    return {"convert_s": round(seconds, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "output_hash": hashlib.blake2b(out, digest_size=16).hexdigest()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--tree", nargs="+", default=[str(ROOT)], help="Folders with a converter.py to compare")
+    parser.add_argument("--retained", nargs=2, metavar=("TREE", "EXPORT"), help=argparse.SUPPRESS)
+    parser.add_argument("--full", nargs=2, metavar=("TREE", "EXPORT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.retained or args.full:
+        tree, export = map(pathlib.Path, args.retained or args.full)
+        print(json.dumps(retained(tree, export) if args.retained else full_run(tree, export)))
+        return
+
+    from make_export import generate, MIX
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        export = pathlib.Path(tmp)
+        generate(export, 1, args.messages, MIX)
+        # Fill the media cache, so only the messages are measured
+        subprocess.run([sys.executable, str(ROOT / "converter.py"), "--path", str(export), "--chat_id", "1"],
+                       check=True, stdout=subprocess.DEVNULL)
+        for tree in map(pathlib.Path, args.tree):
+            r = {"tree": str(tree.resolve())}
+            for step in ("--retained", "--full"):
+                # Each in a fresh process: the RSS of one run
+                p = subprocess.run([sys.executable, __file__, step, str(tree.resolve()), str(export)],
+                                   capture_output=True, text=True, check=True)
+                r.update(json.loads(p.stdout))
+            results.append(r)
+    same = len({r.pop("output_hash") for r in results}) == 1
+    print(json.dumps({"messages": args.messages, "same_output": same, "results": results}, indent=2))
+    if not same:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Parity check of converter.py's html parsers: lxml must give the messages html.parser gives.
+
+Parses every page of a synthetic export (see make_export.py, with html
+comments added to every other text), or of --path, with both parsers and
+compares the messages one by one; any difference is printed and the
+exit status is 1:
+
+    python bench/parser_parity.py --pages 5 --per-page 2000
+    python bench/parser_parity.py --path <backup folder>
+"""
+import argparse
+import itertools
+import json
+import pathlib
+import re
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+import converter
+from make_export import generate, MIX
+
+TEXT_DIV = re.compile(r'(<div class="text">\n)(.*?)(\n\s*</div>)', re.S)
+
+def add_comments(export: pathlib.Path):
+    # Comments in every other text div, between words and inside the formatting tags
+    toggle = itertools.cycle((True, False))
+
+    def commented(m):
+        if not next(toggle):
+            return m.group(0)
+        text = m.group(2).replace(" ", " <!-- note --> ", 1).replace("<strong>", "<strong><!-- b -->")
+        return m.group(1) + "<!-- start -->" + text + m.group(3)
+
+    for html in export.glob("messages*.html"):
+        html.write_text(TEXT_DIV.sub(commented, html.read_text(encoding="utf-8")), encoding="utf-8")
+
+def parse(export: pathlib.Path, parser: str):
+    # The messages of every page as written to messages*.json, and the parse time
+    last_sender = {}
+    messages = []
+    t = time.perf_counter()
+    for html in sorted(export.glob("messages*.html"), key=converter.html_sort_key):
+        msgs = converter.parse_html_to_messages(html, export, last_sender, parser)
+        messages += [(html.name, converter.order_message(msg)) for msg in msgs]
+    return time.perf_counter() - t, messages
+
+def differences(expected, got, limit):
+    # (page, index on the page, html.parser message, lxml message) of the first "limit" differences
+    diffs = []
+    for i, (a, b) in enumerate(zip(expected, got)):
+        if a != b:
+            diffs.append((a[0], i, a[1], b[1]))
+            if len(diffs) == limit:
+                break
+    return diffs
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Check this export instead of a synthetic one")
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--per-page", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--show", type=int, default=5, help="Differences printed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        export = pathlib.Path(args.path or tmp)
+        if not args.path:
+            generate(export, args.pages, args.per_page, MIX, seed=args.seed)
+            add_comments(export)
+        converter.open_media_cache(pathlib.Path(tmp) / ".media_cache.sqlite")
+        converter.open_media_pool(0)
+        converter.open_export_index(export)
+        # The first pass probes the media, so both parsers are timed on a warm cache
+        html_s, expected = parse(export, "html.parser")
+        lxml_s, got = parse(export, "lxml")
+
+    diffs = differences(expected, got, args.show)
+    same = not diffs and len(expected) == len(got)
+    print(json.dumps({"messages": {"html.parser": len(expected), "lxml": len(got)}, "same_output": same,
+                      "html.parser_s": round(html_s, 2), "lxml_s": round(lxml_s, 2)}, indent=2))
+    for page, i, a, b in diffs:
+        print(f"\n{page}, message {i}:\n  html.parser: {json.dumps(a, ensure_ascii=False)}"
+              f"\n  lxml:        {json.dumps(b, ensure_ascii=False)}")
+    if not same:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark: every stage from the html export to the import text, timed on its own.
+
+    get_file_info            every media file probed, without the media cache
+    parse_html_to_messages   every page parsed (media info from a warm cache)
+    convert                  every page parsed and written to messages*.json
+    merge                    merge.py: messages*.json -> result.json
+    load_result              result.json read back with json.load
+    convert_json_to_whatsapp_format   the import text of the whole chat
+
+The export is made by make_export.py (or taken from --path). Each stage
+is run --repeat times, the fastest run is kept. The results, with the
+commit and the export they were measured on, are written as JSON to
+compare commits:
+
+    python bench/run.py --pages 20 --per-page 1000 --output before.json
+    git checkout other-branch
+    python bench/run.py --pages 20 --per-page 1000 --compare before.json
+"""
+import argparse
+import importlib
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+import converter
+import merge
+from make_export import generate, MIX
+
+def media_files(export: pathlib.Path):
+    return sorted(p for d in export.iterdir() if d.is_dir() and not d.name.startswith(".")
+                  for p in d.rglob("*") if p.is_file() and "_thumb" not in p.name)
+
+def stages(export: pathlib.Path, work: pathlib.Path, parser: str):
+    # {name: function}, run in this order: each stage may use the output of the ones before
+    htmls = sorted(export.glob("messages*.html"), key=converter.html_sort_key)
+    outs = [work / html.with_suffix(".json").name for html in htmls]
+    chat_name = converter.read_chat_name(htmls[0], parser)
+    imp = importlib.import_module("import")
+    loaded = {}
+
+    def get_file_info():
+        converter.open_media_cache(None)
+        converter.open_export_index(export)
+        files = media_files(export)
+        for fp in files:
+            converter.get_file_info(fp, export)
+        return len(files)
+
+    def warm_cache():
+        converter.open_media_cache(work / ".media_cache.sqlite")
+        converter.open_export_index(export)
+        for fp in media_files(export):
+            converter.get_file_info(fp, export)
+
+    def parse_html_to_messages():
+        last_sender = {}
+        return sum(len(converter.parse_html_to_messages(html, export, last_sender, parser)) for html in htmls)
+
+    def convert():
+        last_sender = {}
+        for html, out in zip(htmls, outs):
+            converter.convert(html, out, export, chat_name, 1, last_sender, parser)
+        return sum(out.stat().st_size for out in outs)
+
+    def merge_result():
+        count, _ = merge.merge_files(outs, work / "result.json")
+        return count
+
+    def load_result():
+        with (work / "result.json").open(encoding="utf-8") as f:
+            loaded["data"] = json.load(f)
+        return len(loaded["data"]["messages"])
+
+    def convert_json_to_whatsapp_format():
+        lines, files = imp.convert_json_to_whatsapp_format(loaded["data"])
+        return len(lines)
+
+    return warm_cache, {
+        "get_file_info": get_file_info,
+        "parse_html_to_messages": parse_html_to_messages,
+        "convert": convert,
+        "merge": merge_result,
+        "load_result": load_result,
+        "convert_json_to_whatsapp_format": convert_json_to_whatsapp_format,
+    }
+
+def git_commit():
+    # "abc1234", "abc1234-dirty" with uncommitted changes, None outside git
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout
+    if not commit.strip():
+        return None
+    dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                           capture_output=True, text=True).stdout.strip()
+    return commit.strip() + ("-dirty" if dirty else "")
+
+def run(export: pathlib.Path, repeat: int, parser: str, only=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        warm_cache, todo = stages(export, pathlib.Path(work), parser)
+        # Probes run inline: get_file_info is the probing cost, parse_html_to_messages the parsing one
+        converter.open_media_pool(0)
+        for name, fn in todo.items():
+            if name == "parse_html_to_messages":
+                warm_cache()
+            times = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                n = fn()
+                times.append(time.perf_counter() - t)
+            if only and name not in only:
+                continue
+            results[name] = {"seconds": round(min(times), 4), "median_s": round(statistics.median(times), 4),
+                             "count": n}
+    return results
+
+def compare(results: dict, old: dict, max_slowdown: float):
+    # Prints the ratio of every stage to "old", returns the stages slower than max_slowdown
+    slower = []
+    print(f"{'stage':34} {old.get('commit') or 'before':>12} {results.get('commit') or 'now':>12}   ratio")
+    for name, r in results["stages"].items():
+        before = old["stages"].get(name)
+        if not before:
+            continue
+        ratio = r["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        flag = " slower" if ratio > max_slowdown else ""
+        print(f"{name:34} {before['seconds']:11.3f}s {r['seconds']:11.3f}s   {ratio:5.2f}{flag}")
+        if flag:
+            slower.append(name)
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", help="Benchmark this export instead of a synthetic one")
+    parser.add_argument("--pages", type=int, default=10, help="Pages of the synthetic export")
+    parser.add_argument("--per-page", type=int, default=1000, help="Messages per page of the synthetic export")
+    parser.add_argument("--media-files", type=int, default=8, help="Distinct files of every media kind")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--parser", choices=converter.PARSERS, default="html.parser")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every stage, the fastest is kept")
+    parser.add_argument("--stage", nargs="+", help="Report only these stages (the others still run)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Results of another run (--output) to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=1.3,
+                        help="With --compare, fail when a stage is slower than this ratio "
+                             "(stages under a second vary by 20%% between identical runs)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.path:
+            export = pathlib.Path(args.path)
+            source = {"path": str(export.resolve())}
+        else:
+            export = pathlib.Path(tmp)
+            generate(export, args.pages, args.per_page, MIX, args.media_files, args.seed)
+            source = {"pages": args.pages, "per_page": args.per_page, "media_files": args.media_files,
+                      "seed": args.seed}
+        source["html_mb"] = round(sum(p.stat().st_size for p in export.glob("messages*.html")) / 1e6, 2)
+        stage_results = run(export, args.repeat, args.parser, args.stage)
+
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parser": args.parser,
+        "repeat": args.repeat,
+        "export": source,
+        "stages": stage_results,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(text + "\n", encoding="utf-8")
+    print(text)
+    if args.compare:
+        old = json.loads(pathlib.Path(args.compare).read_text(encoding="utf-8"))
+        if old.get("export") != source or old.get("parser") != args.parser:
+            print("Warning: the results compared were not measured on the same export")
+        if compare(results, old, args.max_slowdown):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
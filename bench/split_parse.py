@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Scaling of converter.py --split on one huge messages.html.
+
+Writes a one-page synthetic export (see make_export.py), converts it
+with --split 1 (the sequential parser) then with more processes, and
+reports the time and speedup of each; the outputs must be identical:
+
+    python bench/split_parse.py --messages 200000 --split 1 2 4 8
+
+The media cache is filled first, so the runs time the parsing. The same
+messages cut in two pages are then converted with --jobs 2 and the
+largest --split, which must give the output of --jobs 1 --split 1.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "bench"))
+from make_export import generate, MIX
+
+def convert(export: pathlib.Path, split: int, args, jobs=1):
+    cmd = [sys.executable, str(ROOT / "converter.py"), "--path", str(export), "--chat_id", "1", "--full",
+           "--split", str(split), "--jobs", str(jobs), "--parser", args.parser, "--format", args.format]
+    if args.stream:
+        cmd.append("--stream")
+    t = time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - t
+    digest = hashlib.blake2b(digest_size=16)
+    for out in sorted(export.glob("messages*.json*")):
+        digest.update(out.name.encode() + b"\0" + out.read_bytes())
+    return seconds, digest.hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--split", type=int, nargs="+", help="Process counts to try (default: 1, 2, 4... up to the cores)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every count, the fastest is kept")
+    parser.add_argument("--parser", choices=("html.parser", "lxml"), default="html.parser")
+    parser.add_argument("--format", choices=("pretty", "compact", "jsonl"), default="pretty")
+    parser.add_argument("--stream", action="store_true", help="Pass --stream to the converter")
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    splits = args.split or sorted({1} | {2 ** i for i in range(1, 8) if 2 ** i <= cores} | {cores})
+    with tempfile.TemporaryDirectory() as tmp:
+        export = pathlib.Path(tmp)
+        generate(export, 1, args.messages, MIX)
+        html_mb = (export / "messages.html").stat().st_size / 1e6
+        convert(export, 1, args)
+        results = []
+        for split in splits:
+            runs = [convert(export, split, args) for _ in range(args.repeat)]
+            results.append({"split": split, "seconds": round(min(s for s, _ in runs), 2), "output": runs[0][1]})
+    with tempfile.TemporaryDirectory() as tmp:
+        # --split inside the --jobs workers
+        export = pathlib.Path(tmp)
+        generate(export, 2, args.messages // 2, MIX)
+        _, expected_jobs = convert(export, 1, args)
+        seconds, output = convert(export, max(2, splits[-1]), args, jobs=2)
+        jobs = {"jobs": 2, "split": max(2, splits[-1]), "seconds": round(seconds, 2),
+                "same_output": output == expected_jobs}
+    base, expected = results[0]["seconds"], results[0]["output"]
+    for r in results:
+        r["speedup"] = round(base / r["seconds"], 2)
+        r["same_output"] = r.pop("output") == expected
+    print(json.dumps({"messages": args.messages, "html_mb": round(html_mb, 1), "cores": cores,
+                      "parser": args.parser, "results": results, "with_jobs": jobs}, indent=2))
+    if not all(r["same_output"] for r in results) or not jobs["same_output"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Startup time of converter.py.
+
+Measures "python -X importtime -c 'import converter'" and the wall time of
+"converter.py --help", and fails if a heavy dependency is loaded at import
+time or the import takes longer than --max-ms:
+
+    python bench/startup.py --runs 5 --max-ms 400
+"""
+import argparse
+import json
+import pathlib
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# Must only be imported when a message actually needs them
+HEAVY = ("bs4", "PIL", "mutagen", "tinytag", "moviepy", "numpy", "imageio", "lxml")
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+def import_time(module: str):
+    # (cumulative us of "module", {top-level package: cumulative us})
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                       cwd=ROOT, capture_output=True, text=True, check=True)
+    total, packages = 0, {}
+    for line in r.stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if not m:
+            continue
+        cumulative, name = int(m.group(2)), m.group(4)
+        if name == module:
+            total = cumulative
+        top = name.split(".")[0]
+        packages[top] = max(packages.get(top, 0), cumulative)
+    return total, packages
+
+def help_time():
+    t = time.perf_counter()
+    subprocess.run([sys.executable, "converter.py", "--help"], cwd=ROOT, capture_output=True, check=True)
+    return time.perf_counter() - t
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="Runs per measurement (the median is reported)")
+    parser.add_argument("--max-ms", type=float, default=0, help="Fail if importing converter takes longer (0 = no limit)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    imports = [import_time("converter") for _ in range(args.runs)]
+    import_ms = statistics.median(t for t, _ in imports) / 1000
+    help_ms = statistics.median(help_time() for _ in range(args.runs)) * 1000
+    packages = imports[-1][1]
+    heavy = sorted(p for p in HEAVY if p in packages)
+    slowest = sorted(packages.items(), key=lambda kv: -kv[1])[:8]
+
+    if args.json:
+        print(json.dumps({
+            "import_ms": round(import_ms, 1),
+            "help_ms": round(help_ms, 1),
+            "heavy_imports": heavy,
+            "slowest": {name: round(us / 1000, 1) for name, us in slowest},
+        }, indent=2))
+    else:
+        print(f"import converter: {import_ms:.1f} ms (median of {args.runs})")
+        print(f"converter.py --help: {help_ms:.1f} ms")
+        for name, us in slowest:
+            print(f"  {name:<24}{us / 1000:8.1f} ms")
+
+    failed = False
+    if heavy:
+        print("❌ loaded at import time: " + ", ".join(heavy), file=sys.stderr)
+        failed = True
+    if args.max_ms and import_ms > args.max_ms:
+        print(f"❌ import takes {import_ms:.1f} ms > {args.max_ms} ms", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
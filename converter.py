@@ -3,20 +3,39 @@ import os
 import sys
 import json
 import shutil
+import functools
 import argparse
 import pathlib
 import re
 from datetime import datetime, timezone
-from bs4 import BeautifulSoup, NavigableString, Tag
-from PIL import Image
 import subprocess
 import mimetypes
-from collections import OrderedDict
-from mutagen import File as MutagenFile
+import hashlib
+import mmap
+import sqlite3
+import threading
+from collections import OrderedDict, Counter, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
 import pathlib, shutil, subprocess, json
-from tinytag import TinyTag
-from moviepy import VideoFileClip, AudioFileClip
-
+try:
+    import stage_profile as profiling
+except ImportError:
+    sys.exit("stage_profile.py must be next to converter.py")
+try:
+    import merge
+    from merge import FORMATS, natural_key as html_sort_key
+except ImportError:
+    sys.exit("merge.py must be next to converter.py")
+# bs4, PIL, mutagen, tinytag and moviepy (numpy, imageio...) are imported
+# where they are first needed: "--help" or a text-only chat never loads them
+
+
+# Names used in the backup and their IDs
+sender_map = {
+    "User1Name": "user111111111",
+    "User2Name": "user222222222"
+}
 
 # Desired order of keys in each message
 KEY_ORDER = [
@@ -34,7 +53,111 @@ KEY_ORDER = [
     "longitude", "message_id", "text", "text_entities"   
 ]
 
-def order_message(msg: dict) -> OrderedDict:
+class Record(MutableMapping):
+    # A dict in less memory: the usual keys are slots (KEYS), the others go to a lazy "extra" dict
+    __slots__ = ("extra",)
+    KEYS = {}  # key -> slot
+
+    def __init__(self, *args, **keys):
+        self.extra = None
+        if args or keys:
+            self.update(*args, **keys)
+
+    def __getitem__(self, key):
+        slot = self.KEYS.get(key)
+        try:
+            return getattr(self, slot) if slot else self.extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        slot = self.KEYS.get(key)
+        if slot:
+            setattr(self, slot, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        slot = self.KEYS.get(key)
+        try:
+            if slot:
+                delattr(self, slot)
+            else:
+                del self.extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        slot = self.KEYS.get(key)
+        if slot:
+            return hasattr(self, slot)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        slot = self.KEYS.get(key)
+        if slot:
+            return getattr(self, slot, default)
+        return default if self.extra is None else self.extra.get(key, default)
+
+    def __iter__(self):
+        # Slot keys first, in slot order, then the others as they were added
+        for key, slot in self.KEYS.items():
+            if hasattr(self, slot):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def to_dict(self):
+        # dict(self) in one pass, without the MutableMapping calls
+        d = {}
+        for key, slot in self.KEYS.items():
+            value = getattr(self, slot, MISSING)
+            if value is not MISSING:
+                d[key] = value
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+MISSING = object()
+
+class Message(Record):
+    # One parsed message, its usual keys as slots
+    __slots__ = ("id", "type", "date", "date_unixtime", "from_", "from_id", "actor", "actor_id",
+                 "text", "text_entities")
+    KEYS = {"id": "id", "type": "type", "date": "date", "date_unixtime": "date_unixtime", "from": "from_",
+            "from_id": "from_id", "actor": "actor", "actor_id": "actor_id", "text": "text",
+            "text_entities": "text_entities"}
+
+class Entity(Record):
+    # One text entity, written as type, text, then href, language or collapsed
+    __slots__ = ("type", "text", "href", "language", "collapsed")
+    KEYS = {key: key for key in __slots__}
+
+    def __init__(self, type, text, **keys):
+        self.extra = None
+        self.type = type
+        self.text = text
+        for key, value in keys.items():
+            self[key] = value
+
+def plain(value):
+    # Entity lists as the dicts json writes
+    if isinstance(value, list):
+        return [v.to_dict() if isinstance(v, Entity) else v for v in value]
+    return value
+
+def order_message(msg) -> dict:
+    # The message as a dict in the JSON key order, built when it is written
+    if isinstance(msg, Record):
+        msg = msg.to_dict()
     if msg.get("type") == "service" and msg.get("action") == "phone_call":
         key_order = [
             "id", "type", "date", "date_unixtime",
@@ -54,162 +177,503 @@ def order_message(msg: dict) -> OrderedDict:
     else:
         key_order = KEY_ORDER
 
-    od = OrderedDict()
+    od = {}
     for k in key_order:
         if k in msg:
             od[k] = msg[k]
     for k, v in msg.items():
         if k not in od:
             od[k] = v
+    if "text" in od:
+        od["text"] = plain(od["text"])
+    if "text_entities" in od:
+        od["text_entities"] = plain(od["text_entities"])
     return od
 
-def get_video_duration_ffprobe(fp: pathlib.Path):
-    import subprocess
-    import json
+@functools.lru_cache(maxsize=4096)
+def parse_date_title(title: str):
+    # "01.01.2024 10:00:00 UTC+03:00" -> ("2024-01-01T10:00:00", "1704092400")
+    dt_obj = datetime.strptime(title, "%d.%m.%Y %H:%M:%S UTC%z")
+    return dt_obj.strftime("%Y-%m-%dT%H:%M:%S"), str(int(dt_obj.replace(tzinfo=None).timestamp()))
+
+class DateFiller:
+    # Dates of undated service messages: the last dated message before them, at the top of a page the first after
+    def __init__(self):
+        self.last = None
+        self.waiting = []
+
+    def seen(self, date):
+        self.last = date
+        for msg in self.waiting:
+            msg["date"], msg["date_unixtime"] = date
+        self.waiting = []
+
+    def fill(self, msg):
+        if self.last:
+            msg["date"], msg["date_unixtime"] = self.last
+        else:
+            self.waiting.append(msg)
+
+@functools.lru_cache(maxsize=None)
+def find_ffprobe():
+    return shutil.which("ffprobe")
 
-    exe = shutil.which("ffprobe")
-    if not exe:
-        return None
+def run_probe(cmd):
+    count("subprocesses")
+    with profiling.stage("ffprobe"):
+        return subprocess.run(cmd, capture_output=True, text=True)
 
-    # We try first through stream
+def probe_media(path: pathlib.Path) -> dict:
+    # Durations, size, rotation and codecs from one ffprobe run ({} without ffprobe or on error)
+    exe = find_ffprobe()
+    if not exe:
+        return {}
     cmd = [
         exe, "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=duration",
+        "-show_entries", "stream=codec_type,codec_name,width,height,duration:stream_tags=rotate"
+                         ":stream_side_data=rotation:format=duration",
         "-of", "json",
-        str(fp)
+        str(path)
     ]
-    r = subprocess.run(cmd, capture_output=True, text=True)
+    r = run_probe(cmd)
+    if r.returncode != 0:
+        return {}
     try:
         data = json.loads(r.stdout)
-        dur = data.get("streams", [{}])[0].get("duration")
-        if dur:
-            return int(float(dur))
+    except ValueError:
+        return {}
+    meta = {"duration": data.get("format", {}).get("duration")}
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if audio:
+        meta["audio_codec_name"] = audio.get("codec_name")
+    if video:
+        meta["codec_name"] = video.get("codec_name")
+        meta["width"], meta["height"] = video.get("width"), video.get("height")
+        meta["stream_duration"] = video.get("duration")
+        # older ffmpeg writes a "rotate" tag, newer a display matrix
+        rotation = video.get("tags", {}).get("rotate")
+        for side in video.get("side_data_list", []):
+            rotation = side.get("rotation", rotation)
+        if rotation:
+            meta["rotation"] = abs(int(float(rotation)))
+    return meta
+
+def audio_duration(fp: pathlib.Path):
+    # Header readers first, a subprocess only if neither knows the format
+    try:
+        from mutagen import File as MutagenFile
+        audio = MutagenFile(str(fp))
+        if audio and getattr(audio.info, "length", None):
+            return audio.info.length
     except Exception:
         pass
-
-    # If it didn't work, we try through format
-    cmd = [
-        exe, "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "json",
-        str(fp)
-    ]
-    r = subprocess.run(cmd, capture_output=True, text=True)
     try:
-        data = json.loads(r.stdout)
-        dur = data.get("format", {}).get("duration")
-        if dur:
-            return int(float(dur))
+        from tinytag import TinyTag
+        duration = TinyTag.get(str(fp)).duration
+        if duration:
+            return duration
     except Exception:
         pass
-
-    return None
-
-def find_nearest_date(div):
-    # Let's try to take the date from the message itself
-    d = div.find("div", class_="pull_right date details")
-    if d and d.has_attr("title"):
-        dt_str = d["title"]
-        dt_obj = datetime.strptime(dt_str, "%d.%m.%Y %H:%M:%S UTC%z")
-        return dt_obj.strftime("%Y-%m-%dT%H:%M:%S"), str(int(dt_obj.replace(tzinfo=None).timestamp()))
-    # Search in the previous ones
-    prev = div.find_previous_sibling("div", class_="message")
-    while prev:
-        d_prev = prev.find("div", class_="pull_right date details")
-        if d_prev and d_prev.has_attr("title"):
-            dt_str = d_prev["title"]
-            dt_obj = datetime.strptime(dt_str, "%d.%m.%Y %H:%M:%S UTC%z")
-            return dt_obj.strftime("%Y-%m-%dT%H:%M:%S"), str(int(dt_obj.replace(tzinfo=None).timestamp()))
-        prev = prev.find_previous_sibling("div", class_="message")
-
-    # If you didn’t find it, look in the following (down the DOM)
-    next_ = div.find_next_sibling("div", class_="message")
-    while next_:
-        d_next = next_.find("div", class_="pull_right date details")
-        if d_next and d_next.has_attr("title"):
-            dt_str = d_next["title"]
-            dt_obj = datetime.strptime(dt_str, "%d.%m.%Y %H:%M:%S UTC%z")
-            return dt_obj.strftime("%Y-%m-%dT%H:%M:%S"), str(int(dt_obj.replace(tzinfo=None).timestamp()))
-        next_ = next_.find_next_sibling("div", class_="message")
-
-    # Didn't find anything at all - let there be empty lines
-    return "", ""
-
-def probe_format_duration(path: pathlib.Path) -> float | None:
-    exe = shutil.which("ffprobe")
-    if not exe:
+    if find_ffprobe():
+        return probe_media(fp).get("duration")
+    try:
+        from moviepy import AudioFileClip
+        count("moviepy_clips")
+        with profiling.stage("moviepy"):
+            clip = AudioFileClip(str(fp))
+            duration = clip.duration
+            clip.close()
+        return duration
+    except Exception:
         return None
-    cmd = [
-        exe, "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        str(path)
-    ]
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0 or not r.stdout.strip():
+
+PARSERS = ("html.parser", "lxml")
+
+class LxmlTag:
+    # The part of the bs4 API parse_html_to_messages uses, over an lxml element
+    __slots__ = ("_el",)
+
+    def __init__(self, el):
+        self._el = el
+
+    @staticmethod
+    def _matches(el, class_, attrs):
+        if class_:
+            cls = el.get("class")
+            if cls is None:
+                return False
+            # Like bs4: "a b" matches the whole class attribute, "a" - one of the classes
+            if " " in class_:
+                if " ".join(cls.split()) != class_:
+                    return False
+            elif class_ not in cls.split():
+                return False
+        for key, wanted in attrs.items():
+            if wanted and key not in el.attrib:
+                return False
+        return True
+
+    def _first(self, elements, class_, attrs):
+        for el in elements:
+            if self._matches(el, class_, attrs):
+                return LxmlTag(el)
         return None
-    try:
-        return float(r.stdout.strip())
-    except ValueError:
+
+    @property
+    def name(self):
+        return self._el.tag
+
+    @property
+    def contents(self):
+        el = self._el
+        out = [el.text] if el.text else []
+        for child in el:
+            # Comments and processing instructions are skipped, their tail is kept
+            if isinstance(child.tag, str):
+                out.append(LxmlTag(child))
+            if child.tail:
+                out.append(child.tail)
+        return out
+
+    def get(self, key, default=None):
+        value = self._el.get(key)
+        if value is None:
+            return default
+        return value.split() if key == "class" else value
+
+    def has_attr(self, key):
+        return key in self._el.attrib
+
+    def __getitem__(self, key):
+        return self._el.attrib[key]
+
+    def find_all(self, name, class_=None, recursive=True, **attrs):
+        elements = self._el.iterdescendants(name) if recursive else self._el.iterchildren(name)
+        return [LxmlTag(el) for el in elements if self._matches(el, class_, attrs)]
+
+    def find(self, name, class_=None, recursive=True, **attrs):
+        elements = self._el.iterdescendants(name) if recursive else self._el.iterchildren(name)
+        return self._first(elements, class_, attrs)
+
+    def find_parent(self, name, class_=None, **attrs):
+        return self._first(self._el.iterancestors(name), class_, attrs)
+
+    def select_one(self, selector):
+        # Only "tag.class.class" parts joined by descendant combinators
+        steps = []
+        for part in selector.split():
+            name, *classes = part.split(".")
+            steps.append((name or None, set(classes)))
+
+        def step_matches(el, step):
+            name, classes = step
+            return (name is None or el.tag == name) and classes <= set((el.get("class") or "").split())
+
+        for el in self._el.iterdescendants(steps[-1][0]):
+            if not step_matches(el, steps[-1]):
+                continue
+            # The other parts are matched right to left against the ancestors
+            i = len(steps) - 2
+            anc = el.getparent()
+            while i >= 0 and anc is not None and anc is not self._el:
+                if step_matches(anc, steps[i]):
+                    i -= 1
+                anc = anc.getparent()
+            if i < 0:
+                return LxmlTag(el)
         return None
 
-def probe_ffprobe(path: pathlib.Path):
-    exe = shutil.which("ffprobe")
-    if not exe:
-        return {}
-    cmd = [
-        exe, "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height,duration",
-        "-of", "json",
-        str(path)
-    ]
-    r = subprocess.run(cmd, capture_output=True, text=True)
-    if r.returncode != 0:
-        return {}
-    data = json.loads(r.stdout)
-    return data.get("streams", [{}])[0]
+    def get_text(self, strip=False):
+        if strip:
+            return "".join(t for t in (t.strip() for t in self._el.itertext()) if t)
+        return "".join(self._el.itertext())
+
+    def decompose(self):
+        # Keep the tail as a separate text node, as bs4 does
+        self._el.clear(keep_tail=True)
+        self._el.tag = "decomposed"
+
+def markup_string(node):
+    # bs4 keeps comments and processing instructions as text nodes (with a "<!--" or "<?"
+    # PREFIX); LxmlTag.contents skips them, so the text walks skip them too
+    return bool(getattr(node, "PREFIX", ""))
+
+def make_soup(text: str, parser: str = "html.parser"):
+    if parser == "lxml":
+        import lxml.html
+        return LxmlTag(lxml.html.document_fromstring(text))
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(text, parser)
+
+def open_image(fp: pathlib.Path):
+    from PIL import Image
+    with profiling.stage("pil"):
+        return Image.open(fp)
 
 def div_sticker_emoji(fp: pathlib.Path):
     # TODO: Replace with real reading of emoji from HTML tree
     return "❤️"
 
+# Counters of the run (per worker process, summed up by main)
+STATS = Counter()
+STATS_LOCK = threading.Lock()
+
+def count(key, n=1):
+    # Probe threads update STATS too
+    with STATS_LOCK:
+        STATS[key] += n
+
+def file_hash(fp: pathlib.Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with fp.open("rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+class MediaCache:
+    # get_file_info results in sqlite, valid while the size and mtime (or with use_hash the content) match
+    VERSION = 2  # Bump when get_file_info starts returning something else
+
+    def __init__(self, path: pathlib.Path, use_hash: bool = False):
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        # WAL lets the --jobs worker processes read and write the same file
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            "rel TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, version INTEGER, info TEXT)"
+        )
+        self.db.commit()
+
+    def get(self, rel: str, fp: pathlib.Path, st: os.stat_result):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, hash, info FROM media WHERE rel = ? AND version = ?",
+                (rel, self.VERSION),
+            ).fetchone()
+        if row:
+            size, mtime_ns, digest, info = row
+            if size == st.st_size and mtime_ns == st.st_mtime_ns:
+                count("cache_hits")
+                return json.loads(info)
+            if self.use_hash and digest and size == st.st_size and digest == file_hash(fp):
+                with self.lock:
+                    self.db.execute("UPDATE media SET mtime_ns = ? WHERE rel = ?", (st.st_mtime_ns, rel))
+                    self.db.commit()
+                count("cache_hits")
+                return json.loads(info)
+        count("cache_misses")
+        return None
+
+    def put(self, rel: str, fp: pathlib.Path, st: os.stat_result, info):
+        digest = file_hash(fp) if self.use_hash else None
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?)",
+                (rel, st.st_size, st.st_mtime_ns, digest, self.VERSION, json.dumps(info, ensure_ascii=False)),
+            )
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM media")
+            self.db.commit()
+
+# Set by main (and in every --jobs worker), None = no cache
+media_cache = None
+
+def open_media_cache(path, use_hash=False):
+    global media_cache
+    media_cache = MediaCache(path, use_hash) if path else None
+    return media_cache
+
+class ExportIndex:
+    # Stats and thumbnails of the export folder, scanned once instead of per attachment
+    def __init__(self, export_dir: pathlib.Path):
+        self.stats = {}   # "photos/a.jpg" -> os.stat_result
+        self.thumbs = {}  # "photos/a.jpg" -> "photos/a.jpg_thumb.jpg"
+        self._scan(str(export_dir), "")
+
+    def _scan(self, path: str, prefix: str):
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    self._scan(entry.path, rel + "/")
+                    continue
+                # Symlinked folders are left to the filesystem (see stat_export_file)
+                if entry.is_dir():
+                    continue
+                try:
+                    self.stats[rel] = entry.stat()
+                except OSError:
+                    continue
+                # First match in directory order, as glob returned it
+                i = entry.name.find("_thumb")
+                while i >= 0:
+                    self.thumbs.setdefault(prefix + entry.name[:i], rel)
+                    i = entry.name.find("_thumb", i + 1)
+
+    def stat(self, rel: str):
+        return self.stats.get(rel)
+
+    def thumbnail(self, rel: str):
+        return self.thumbs.get(rel)
+
+    def __contains__(self, rel: str):
+        return rel in self.stats
+
+# Set by main (and in every --jobs worker), None = ask the filesystem
+export_index = None
+
+def open_export_index(export_dir):
+    global export_index
+    export_index = ExportIndex(export_dir) if export_dir else None
+    return export_index
+
+def stat_export_file(fp: pathlib.Path, rel: str):
+    # None if the file is not in the export
+    if export_index is not None:
+        st = export_index.stat(rel)
+        if st is not None:
+            return st
+    # Not indexed: behind a symlinked folder, or named in another case on a
+    # case-insensitive filesystem (Windows, macOS), where fp.stat() finds it
+    try:
+        return fp.stat()
+    except OSError:
+        return None
+
+def find_thumbnail(fp: pathlib.Path, rel: str):
+    # Relative path of the "<name>_thumb*" file next to fp, if any
+    if export_index is not None and rel in export_index:
+        return export_index.thumbnail(rel)
+    thumb = next((t for t in fp.parent.glob(f"{fp.name}_thumb*")), None)
+    return pathlib.PurePosixPath(rel).with_name(thumb.name).as_posix() if thumb else None
+
 def get_file_info(fp: pathlib.Path, export_dir: pathlib.Path):
-    if not fp.exists():
+    rel = fp.relative_to(export_dir).as_posix()
+    st = stat_export_file(fp, rel)
+    if st is None:
         return None
+    if media_cache is None:
+        return timed_probe(fp, export_dir, st)
+    info = media_cache.get(rel, fp, st)
+    if info is None:
+        info = timed_probe(fp, export_dir, st)
+        media_cache.put(rel, fp, st, info)
+    return info
+
+def timed_probe(fp: pathlib.Path, export_dir: pathlib.Path, st: os.stat_result):
+    # probe_file_info, counted by file type for --profile
+    profiling.count("probes" + (fp.suffix.lower() or ".none"))
+    with profiling.stage("probe"):
+        return probe_file_info(fp, export_dir, st)
+
+# Set by main (and in every --jobs worker), None = probe while parsing
+media_pool = None
+media_futures = OrderedDict()  # fp -> Future, so a file used many times is probed once
+# Files kept in media_futures, the least recently used dropped first: --stream
+# memory does not grow with the number of media files
+MEDIA_FUTURES = 4096
+
+# Key of the not yet resolved media of a message (never written out)
+PENDING_MEDIA = "\x00pending_media"
+
+# Messages kept waiting for their media when writing in page order
+MEDIA_WINDOW = 256
+
+def open_media_pool(threads):
+    global media_pool
+    media_pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+    media_futures.clear()
+    return media_pool
+
+def add_media(msg: dict, fp: pathlib.Path, export_dir: pathlib.Path):
+    # msg.update(get_file_info(...)), done by media_pool while parsing goes on
+    if media_pool is None:
+        info = get_file_info(fp, export_dir)
+        if info:
+            msg.update(info)
+        return
+    fut = media_futures.get(fp)
+    if fut is None:
+        fut = media_futures[fp] = media_pool.submit(get_file_info, fp, export_dir)
+        if len(media_futures) > MEDIA_FUTURES:
+            media_futures.popitem(last=False)
+    else:
+        media_futures.move_to_end(fp)
+    msg.setdefault(PENDING_MEDIA, []).append(fut)
+
+def add_file_link(msg: dict, href: str):
+    # Applied after the local files found before it, as without media_pool
+    if PENDING_MEDIA in msg:
+        msg[PENDING_MEDIA].append({"file": href})
+    else:
+        msg["file"] = href
+
+def resolve_media(msg: dict):
+    # Merge the probed media into the message, in the order they were found
+    pending = msg.pop(PENDING_MEDIA, None)
+    if pending:
+        for update in pending:
+            info = update.result() if isinstance(update, Future) else update
+            if info:
+                msg.update(info)
+        # extract_location has already dropped "file"
+        if "location_information" in msg:
+            msg.pop("file", None)
+    return msg
+
+def resolve_media_in_order(msgs, window: int = MEDIA_WINDOW):
+    # Keeps up to "window" messages probing ahead of the one being written
+    waiting = deque()
+    for msg in msgs:
+        waiting.append(msg)
+        if len(waiting) > window:
+            yield resolve_media(waiting.popleft())
+    while waiting:
+        yield resolve_media(waiting.popleft())
+
+def probe_file_info(fp: pathlib.Path, export_dir: pathlib.Path, st: os.stat_result):
     rel = fp.relative_to(export_dir).as_posix()
     info = {
         "file": rel,
         "file_name": fp.name,
-        "file_size": fp.stat().st_size,
+        "file_size": st.st_size,
     }
     suf = fp.suffix.lower()
 
     # "thumbnail" we are looking for a file of the type <stem>_thumb*<suffix>
-    thumb = next((t for t in fp.parent.glob(f"{fp.name}_thumb*")), None)    
+    thumb = find_thumbnail(fp, rel)
     if thumb:
-        info["thumbnail"] = thumb.relative_to(export_dir).as_posix()
-        info["thumbnail_file_size"] = thumb.stat().st_size
+        info["thumbnail"] = thumb
+        info["thumbnail_file_size"] = stat_export_file(export_dir / thumb, thumb).st_size
 
     # Special processing for the photos folder
     if rel.startswith("photos/") and suf in (".jpg", ".jpeg", ".png", ".bmp"):
+        with open_image(fp) as img:
+            width, height = img.size
         return {
             "photo":           rel,
-            "photo_file_size": fp.stat().st_size,
-            "width":           Image.open(fp).size[0],
-            "height":          Image.open(fp).size[1],
+            "photo_file_size": info["file_size"],
+            "width":           width,
+            "height":          height,
         }
 
     # Everything else: static images, etc.
     if suf in (".jpg", ".jpeg", ".png", ".bmp"):
-        with Image.open(fp) as img:
+        with open_image(fp) as img:
             info["width"], info["height"] = img.size
         info["mime_type"]  = mimetypes.guess_type(str(fp))[0] or "image/jpeg"
 
     # Static stickers (.webp in stickers folder)
     elif suf == ".webp" and "stickers" in rel:
-        with Image.open(fp) as img:
+        with open_image(fp) as img:
             info["width"], info["height"] = img.size
         info["mime_type"] = mimetypes.guess_type(str(fp))[0] or "image/webp"
         info["media_type"] = "sticker"
@@ -230,49 +694,56 @@ def get_file_info(fp: pathlib.Path, export_dir: pathlib.Path):
         info["sticker_emoji"] = div_sticker_emoji(fp)
     # We get the size and duration through ffprobe
         try:
-            meta = probe_ffprobe(fp)
+            meta = probe_media(fp)
             if meta.get("width"):
                 info["width"] = int(meta["width"])
             if meta.get("height"):
                 info["height"] = int(meta["height"])
-            if meta.get("duration"):
-                info["duration_seconds"] = int(float(meta["duration"]))
+            if meta.get("stream_duration"):
+                info["duration_seconds"] = int(float(meta["stream_duration"]))
             if "duration_seconds" not in info or not info["duration_seconds"]:
-                dur = get_video_duration_ffprobe(fp)
-                if dur:
-                    info["duration_seconds"] = dur
+                dur = meta.get("stream_duration") or meta.get("duration")
+                if dur and int(float(dur)):
+                    info["duration_seconds"] = int(float(dur))
         except Exception as e:
             print("Error getting duration:", e) # ← or just pass
 
     # GIF
     elif suf == ".gif":
-        meta = probe_ffprobe(fp)
-        with Image.open(fp) as img:
+        meta = probe_media(fp)
+        with open_image(fp) as img:
             info["width"], info["height"] = img.size
-        if meta.get("duration"):
-            info["duration_seconds"] = int(float(meta["duration"]))
+        if meta.get("stream_duration"):
+            info["duration_seconds"] = int(float(meta["stream_duration"]))
         info["mime_type"] = mimetypes.guess_type(str(fp))[0] or "image/gif"
         info["media_type"] = "animation"
 
      # Video
     elif suf in (".mp4", ".webm", ".avi", ".mov"):
+        meta = probe_media(fp)
         # if the file is NOT from the files folder, we get the duration and dimensions
         if not rel.startswith("files/"):
-            try:
-                clip = VideoFileClip(str(fp))
-                # Duration & Size
-                info["duration_seconds"] = int(clip.duration)
-                info["width"], info["height"] = clip.size
-                clip.close()
-            except Exception:
-                # fallback ffprobe, if MoviePy can't
-                meta = probe_ffprobe(fp)
-                if meta.get("duration"):
-                    info["duration_seconds"] = int(float(meta["duration"]))
-                if meta.get("width"):
-                    info["width"] = int(meta["width"])
-                if meta.get("height"):
-                    info["height"] = int(meta["height"])
+            if meta:
+                # Same numbers moviepy reports: container duration, display size
+                dur = meta.get("duration") or meta.get("stream_duration")
+                if dur:
+                    info["duration_seconds"] = int(float(dur))
+                if meta.get("width") and meta.get("height"):
+                    info["width"], info["height"] = int(meta["width"]), int(meta["height"])
+                    if meta.get("rotation") in (90, 270):
+                        info["width"], info["height"] = info["height"], info["width"]
+            elif not find_ffprobe():
+                # No ffprobe on this machine, let moviepy spawn ffmpeg instead
+                try:
+                    from moviepy import VideoFileClip
+                    count("moviepy_clips")
+                    with profiling.stage("moviepy"):
+                        clip = VideoFileClip(str(fp))
+                        info["duration_seconds"] = int(clip.duration)
+                        info["width"], info["height"] = clip.size
+                        clip.close()
+                except Exception:
+                    pass
 
         # Type of "media_type"
         if "round_video_messages" in rel:
@@ -285,10 +756,9 @@ def get_file_info(fp: pathlib.Path, export_dir: pathlib.Path):
 
         info["mime_type"] = mimetypes.guess_type(str(fp))[0] or f"video/{suf.lstrip('.')}"
 
-        # If "duration" is still not set, try using ffprobe
+        # If "duration" is still not set, take the video stream one
         if "duration_seconds" not in info:
-            meta = probe_ffprobe(fp)
-            dur = meta.get("duration")
+            dur = meta.get("stream_duration")
             if dur:
                 try:
                     info["duration_seconds"] = int(float(dur))
@@ -297,20 +767,9 @@ def get_file_info(fp: pathlib.Path, export_dir: pathlib.Path):
 
     # Audio & Voice messages
     elif suf in (".m4a", ".mp3", ".ogg"):
-        try:
-            clip = AudioFileClip(str(fp))
-            info["duration_seconds"] = int(clip.duration)
-            clip.close()
-        except Exception:
-            # fallback ffprobe/Mutagen
-            meta = probe_ffprobe(fp)
-            duration = meta.get("duration")
-            if not duration:
-                audio = MutagenFile(str(fp))
-                if audio and hasattr(audio.info, "length"):
-                    duration = audio.info.length
-            if duration:
-                info["duration_seconds"] = int(float(duration))
+        duration = audio_duration(fp)
+        if duration:
+            info["duration_seconds"] = int(float(duration))
 
         info["mime_type"] = mimetypes.guess_type(str(fp))[0] or f"audio/{suf.lstrip('.')}"
         info["media_type"] = "voice_message" if "voice" in rel else "audio_file"
@@ -348,214 +807,314 @@ def extract_location(div, msg):
         msg["text"] = ""
         msg["text_entities"] = []
 
-def parse_html_to_messages(html_path: pathlib.Path, export_dir: pathlib.Path, last_sender: dict):
-    messages = []
-    soup = BeautifulSoup(html_path.read_text(encoding="utf-8"), "html.parser")
-    sender_map = {
-        "User1Name": "user111111111",
-        "User2Name": "user222222222"
-    }
-
-    for div in soup.find_all("div", class_="message"):
-        # ID & Date
-        raw_id = div.get("id", "")
-        msg_id = int(raw_id.replace("message", "")) if raw_id.startswith("message") else -1
-
-        # Date
-        d = div.find("div", class_="pull_right date details")
-        dt, dt_unixtime = "", ""
-        if d and d.has_attr("title"):
-            dt_str = d["title"]
-            dt_obj = datetime.strptime(dt_str, "%d.%m.%Y %H:%M:%S UTC%z")
-            dt = dt_obj.strftime("%Y-%m-%dT%H:%M:%S")
-            dt_unixtime = str(int(dt_obj.replace(tzinfo=None).timestamp()))
-            
-        # Name sender
-        body = div.find("div", class_="body")
-        sender_el = body.find("div", class_="from_name", recursive=False)
-        if sender_el:
-            name = sender_el.get_text(strip=True)
-            uid = sender_map.get(name, "Unknown")
-            last_sender["name"] = name
-            last_sender["from_id"] = uid
-        else:
-            name = last_sender.get("name", "Unknown")
-            uid  = last_sender.get("from_id", "Unknown")
-
-        # Service message
-        is_service = "service" in div.get("class", [])
-        if is_service:
-            dt, dt_unixtime = find_nearest_date(div)
-            body = div.find("div", class_="body details")
-            service_text = body.get_text(strip=True)
-            low_text = service_text.lower()
-            msg = {
-                "id": msg_id,
-                "type": "service",
-                "date": dt,
-                "date_unixtime": dt_unixtime,
-                "actor": name,
-                "actor_id": uid,
-                "text": "",
-                "text_entities": []
-            }
+def parse_message_div(div, export_dir: pathlib.Path, last_sender: dict, dates: DateFiller = None):
+    # The message of one div.message (None for ignored service divs), "dates" shared by the page
+    # ID & Date
+    raw_id = div.get("id", "")
+    msg_id = int(raw_id.replace("message", "")) if raw_id.startswith("message") else -1
 
-            # Clear history
-            if "history cleared" in low_text:
-                msg["action"] = "clear_history"
-                messages.append(msg)
-                continue
-
-            # Change of theme
-            m = re.match(r"(.+?) changed chat theme to (.+)", service_text)
-            if m:
-                msg["action"] = "edit_chat_theme"
-                actor_name = m.group(1).strip()
-                msg["actor"]    = actor_name
-                msg["actor_id"] = sender_map.get(actor_name, "Unknown")
-                msg["emoticon"] = m.group(2).strip()
-                messages.append(msg)
-                continue
-
-            # Pinned message
-            a = body.find("a", onclick=True)
-            pin_re = re.match(r"(.+?) pinned", service_text)
-            if a and pin_re:
-                msg["action"] = "pin_message"
-                msg["actor"] = pin_re.group(1).strip()
-                msg["actor_id"] = sender_map.get(msg["actor"], "Unknown")
-        # Take message_id from onclick
-                if "GoToMessage(" in a["onclick"]:
-                    mid = int(a["onclick"].split("GoToMessage(")[1].split(")")[0])
-                    msg["message_id"] = mid
-                messages.append(msg)
-                continue
-
-            # If do not find - ignore 
-            continue
+    # Date
+    d = div.find("div", class_="pull_right date details")
+    dt, dt_unixtime = "", ""
+    if d and d.has_attr("title"):
+        dt, dt_unixtime = parse_date_title(d["title"])
+        if dates is not None:
+            dates.seen((dt, dt_unixtime))
+        
+    # Name sender
+    body = div.find("div", class_="body")
+    sender_el = body.find("div", class_="from_name", recursive=False)
+    if sender_el:
+        # Interned: one string per sender, not per message
+        name = sys.intern(sender_el.get_text(strip=True))
+        uid = sender_map.get(name, "Unknown")
+        last_sender["name"] = name
+        last_sender["from_id"] = uid
+    else:
+        name = last_sender.get("name", "Unknown")
+        uid  = last_sender.get("from_id", "Unknown")
+
+    # Service message
+    is_service = "service" in div.get("class", [])
+    if is_service:
+        body = div.find("div", class_="body details")
+        service_text = body.get_text(strip=True)
+        low_text = service_text.lower()
+        msg = Message({
+            "id": msg_id,
+            "type": "service",
+            "date": dt,
+            "date_unixtime": dt_unixtime,
+            "actor": name,
+            "actor_id": uid,
+            "text": "",
+            "text_entities": []
+        })
+        if not dt and dates is not None:
+            dates.fill(msg)
+
+        # Clear history
+        if "history cleared" in low_text:
+            msg["action"] = "clear_history"
+            return msg
+
+        # Change of theme
+        m = re.match(r"(.+?) changed chat theme to (.+)", service_text)
+        if m:
+            msg["action"] = "edit_chat_theme"
+            actor_name = m.group(1).strip()
+            msg["actor"]    = actor_name
+            msg["actor_id"] = sender_map.get(actor_name, "Unknown")
+            msg["emoticon"] = m.group(2).strip()
+            return msg
+
+        # Pinned message
+        a = body.find("a", onclick=True)
+        pin_re = re.match(r"(.+?) pinned", service_text)
+        if a and pin_re:
+            msg["action"] = "pin_message"
+            msg["actor"] = pin_re.group(1).strip()
+            msg["actor_id"] = sender_map.get(msg["actor"], "Unknown")
+    # Take message_id from onclick
+            if "GoToMessage(" in a["onclick"]:
+                mid = int(a["onclick"].split("GoToMessage(")[1].split(")")[0])
+                msg["message_id"] = mid
+            return msg
+
+        # If do not find - ignore 
+        return None
 
-        # Call
-        call = div.find("div", class_="media_call")
-        if call:
-            # "actor" alsways from "last_sender"
-            actor = name
-            actor_id = uid
-            call_body = call.find("div", class_="body")
-            status_tag = call_body.find("div", class_="status details") if call_body else None
-            status = status_tag.get_text(strip=True) if status_tag else ""
-            # Duration
-            m = re.search(r"\((\d+)\s*seconds\)", status)
-            duration = int(m.group(1)) if m else None
-            # "discard_reason"
-            st = status.lower()
-            if "outgoing" in st and m:
-                discard_reason = "hangup"
-            elif "outgoing" in st:
-                discard_reason = "busy"
-            elif "cancelled" in st:
-                discard_reason = "missed"
-            elif "declined" in st:
-                discard_reason = "busy"
-            elif "missed" in st:
-                discard_reason = "missed"
-            elif "incoming" in st and m:
-                discard_reason = "hangup"
-            else:
-                discard_reason = st
-
-            call_msg = {
-                "id": msg_id,
-                "type": "service",
-                "date": dt,
-                "date_unixtime": dt_unixtime,
-                "actor": actor,
-                "actor_id": actor_id,
-                "action": "phone_call",
-                "text": "",
-                "text_entities": [],
-                "discard_reason": discard_reason
-            }
-            if duration is not None:
-                call_msg["duration_seconds"] = duration
-            messages.append(call_msg)
-            continue  # Skip simple message if it call
+    # Call
+    call = div.find("div", class_="media_call")
+    if call:
+        # "actor" alsways from "last_sender"
+        actor = name
+        actor_id = uid
+        call_body = call.find("div", class_="body")
+        status_tag = call_body.find("div", class_="status details") if call_body else None
+        status = status_tag.get_text(strip=True) if status_tag else ""
+        # Duration
+        m = re.search(r"\((\d+)\s*seconds\)", status)
+        duration = int(m.group(1)) if m else None
+        # "discard_reason"
+        st = status.lower()
+        if "outgoing" in st and m:
+            discard_reason = "hangup"
+        elif "outgoing" in st:
+            discard_reason = "busy"
+        elif "cancelled" in st:
+            discard_reason = "missed"
+        elif "declined" in st:
+            discard_reason = "busy"
+        elif "missed" in st:
+            discard_reason = "missed"
+        elif "incoming" in st and m:
+            discard_reason = "hangup"
+        else:
+            discard_reason = st
 
-        # Simple message
-        msg = {
+        call_msg = Message({
             "id": msg_id,
-            "type": "message",
+            "type": "service",
             "date": dt,
             "date_unixtime": dt_unixtime,
-            "from": name,
-            "from_id": uid,
+            "actor": actor,
+            "actor_id": actor_id,
+            "action": "phone_call",
             "text": "",
             "text_entities": [],
-        }
+            "discard_reason": discard_reason
+        })
+        if duration is not None:
+            call_msg["duration_seconds"] = duration
+        return call_msg  # Skip simple message if it call
+
+    # Simple message
+    msg = Message({
+        "id": msg_id,
+        "type": "message",
+        "date": dt,
+        "date_unixtime": dt_unixtime,
+        "from": name,
+        "from_id": uid,
+        "text": "",
+        "text_entities": [],
+    })
 
 # Contact or Poll
-        contact_div = div.find("div", class_="media_contact")
-        poll_div    = div.find("div", class_="media_poll")
-
-        if contact_div:
-            # Contact
-            title = contact_div.select_one("div.title.bold")
-            phone = contact_div.select_one("div.status.details")
-            msg["contact_information"] = {
-                "first_name": title.get_text(strip=True) if title else "",
-                "last_name": "",
-                "phone_number": phone.get_text(strip=True) if phone else ""
-            }
-            messages.append(msg)
-            continue
+    contact_div = div.find("div", class_="media_contact")
+    poll_div    = div.find("div", class_="media_poll")
+
+    if contact_div:
+        # Contact
+        title = contact_div.select_one("div.title.bold")
+        phone = contact_div.select_one("div.status.details")
+        msg["contact_information"] = {
+            "first_name": title.get_text(strip=True) if title else "",
+            "last_name": "",
+            "phone_number": phone.get_text(strip=True) if phone else ""
+        }
+        return msg
 
-        elif poll_div:
-            # Source for forward
-            fwd = div.find("div", class_="forwarded body")
-            if fwd:
-                orig = fwd.find("div", class_="from_name", recursive=False)
-                if orig:
-                    for span in orig.find_all("span", class_="date details"):
-                        span.decompose()
-                    msg["forwarded_from"] = orig.get_text(strip=True)
-
-            # Poll
-            q_el = poll_div.find("div", class_="question bold")
-            question = q_el.get_text(strip=True) if q_el else ""
-            total_el = poll_div.find("div", class_="total details")
-            total_voters = int(total_el.get_text(strip=True).split()[0]) if total_el else 0
-
-            answers = []
-            for ans in poll_div.find_all("div", class_="answer"):
-                txt = ans.get_text(strip=True).lstrip("- ").strip()
-                answers.append({"text": txt, "voters": 0, "chosen": False})
-
-            msg["poll"] = {
-                "question": question,
-                "closed": False,
-                "total_voters": total_voters,
-                "answers": answers
-            }
-            messages.append(msg)
-            continue
+    elif poll_div:
+        # Source for forward
+        fwd = div.find("div", class_="forwarded body")
+        if fwd:
+            orig = fwd.find("div", class_="from_name", recursive=False)
+            if orig:
+                for span in orig.find_all("span", class_="date details"):
+                    span.decompose()
+                msg["forwarded_from"] = orig.get_text(strip=True)
 
-        # Text with formatting
-        text_div = div.find("div", class_="text")
-        if text_div:
+        # Poll
+        q_el = poll_div.find("div", class_="question bold")
+        question = q_el.get_text(strip=True) if q_el else ""
+        total_el = poll_div.find("div", class_="total details")
+        total_voters = int(total_el.get_text(strip=True).split()[0]) if total_el else 0
+
+        answers = []
+        for ans in poll_div.find_all("div", class_="answer"):
+            txt = ans.get_text(strip=True).lstrip("- ").strip()
+            answers.append({"text": txt, "voters": 0, "chosen": False})
+
+        msg["poll"] = {
+            "question": question,
+            "closed": False,
+            "total_voters": total_voters,
+            "answers": answers
+        }
+        return msg
+
+    # Text with formatting
+    text_div = div.find("div", class_="text")
+    if text_div:
+        full_text = ""
+        entities = []
+        TAG_MAP = {"strong": "bold", "em": "italic", "u": "underline", "s": "strikethrough",
+                   "blockquote": "blockquote", "pre": "pre", "span": "spoiler", "a": "text_link"}
+
+        def walk(node):
+            nonlocal full_text, entities
+            if isinstance(node, str):
+                txt = node.strip().replace("\n", "")
+                if not txt or markup_string(node):
+                    return
+                full_text += txt
+                entities.append(Entity("plain", txt))
+                return
+            else:
+                tag = node.name
+                if tag == "span" and node.get("aria-hidden") == "true":
+                    etype = "spoiler"
+                else:
+                    etype = TAG_MAP.get(tag)
+                txt = node.get_text().replace("\n", "")
+                if not txt:
+                    return
+                full_text += txt
+                if etype == "pre":
+                    entities.append(Entity("pre", txt, language=""))
+                    return
+                if etype == "blockquote":
+                    entities.append(Entity("blockquote", txt, collapsed=False))
+                    return
+                if etype == "spoiler":
+                    entities.append(Entity("spoiler", txt))
+                    return
+                if node.name == "a" and node.has_attr("href"):
+                    entities.append(Entity("text_link", txt, href=node["href"]))
+                    return
+                else:
+                    entities.append(Entity(etype or "plain", txt))
+                    return
+
+        for child in text_div.contents:
+            walk(child)
+
+        has_formatting = any(e.type != "plain" for e in entities)
+
+        if has_formatting:
+            # Both lists hold the same entities: they are only turned into dicts when written
+            msg["text"] = entities + [""]  # Required empty element
+            msg["text_entities"] = entities + [Entity("plain", "")]
+
+        else:
+            msg["text"] = full_text
+            msg["text_entities"] = entities
+    else:
+        msg["text"] = ""
+        msg["text_entities"] = []
+
+    # reply
+    rep = div.find("div", class_="reply_to")
+    if rep:
+        a = rep.find("a", onclick=True)
+        if a:
+            mid = a["onclick"].split("(")[1].split(")")[0]
+            msg["reply_to_message_id"] = int(mid)
+
+    # Location
+    loc_a = div.find("a", class_="media_location")
+    if loc_a and "q=" in loc_a["href"]:
+        coords = loc_a["href"].split("q=")[1].split("&")[0].split(",")
+        msg["location_information"] = {
+            "latitude": float(coords[0]),
+            "longitude": float(coords[1]),
+        }
+        msg["text"] = ""
+        msg["text_entities"] = []
+        return msg
+
+    # Forward
+    fwd = div.find("div", class_="forwarded body")
+    if fwd:
+        # Forward name
+        orig = fwd.find("div", class_="from_name")
+        if orig:
+            for span in orig.find_all("span"):
+                span.decompose()
+            msg["forwarded_from"] = orig.get_text(strip=True)
+            msg["from"]    = name
+            msg["from_id"] = uid
+
+        # Forward media
+        media_wrap = fwd.find("div", class_="media_wrap")
+        if media_wrap:
+            link = media_wrap.find("a", href=True)
+            if link:
+                href = link["href"]
+                if href.startswith("http"):
+                    add_file_link(msg, href)
+                else:
+                    add_media(msg, export_dir / href, export_dir)
+
+        # Forward text with tags (without empty newline)
+        txt_div = fwd.find("div", class_="text")
+        if txt_div:
             full_text = ""
             entities = []
-            TAG_MAP = {"strong": "bold", "em": "italic", "u": "underline", "s": "strikethrough",
-                       "blockquote": "blockquote", "pre": "pre", "span": "spoiler", "a": "text_link"}
+            TAG_MAP = {
+                "strong": "bold", "em": "italic", "u": "underline", "s": "strikethrough",
+                "blockquote": "blockquote", "pre": "pre", "span": "spoiler", "a": "text_link"
+            }
 
             def walk(node):
                 nonlocal full_text, entities
-                if isinstance(node, NavigableString):
-                    txt = node.strip().replace("\n", "")
-                    if not txt:
+                # plain text (hard discard nodes where txt.strip() is empty)
+                if isinstance(node, str):
+                    raw = str(node)
+                    txt = raw.replace("\n", "")
+                    if not txt.strip() or markup_string(node):
                         return
                     full_text += txt
-                    entities.append({"type": "plain", "text": txt})
+                    entities.append(Entity("plain", txt))
+                # <br> skip (or can be converted to \n – optional)
+                elif node.name == "br":
+                    # if need comment \n:
+                    # full_text += "\n"
                     return
-                elif isinstance(node, Tag):
+                # Formatting tags
+                else:
                     tag = node.name
                     if tag == "span" and node.get("aria-hidden") == "true":
                         etype = "spoiler"
@@ -566,199 +1125,557 @@ def parse_html_to_messages(html_path: pathlib.Path, export_dir: pathlib.Path, la
                         return
                     full_text += txt
                     if etype == "pre":
-                        entities.append({"type": "pre", "text": txt, "language": ""})
-                        return
-                    if etype == "blockquote":
-                        entities.append({"type": "blockquote", "text": txt, "collapsed": False})
-                        return
-                    if etype == "spoiler":
-                        entities.append({"type": "spoiler", "text": txt})
-                        return
-                    if node.name == "a" and node.has_attr("href"):
-                        entities.append({"type": "text_link", "text": txt, "href": node["href"]})
-                        return
+                        entities.append(Entity("pre", txt, language=""))
+                    elif etype == "blockquote":
+                        entities.append(Entity("blockquote", txt, collapsed=False))
+                    elif etype == "spoiler":
+                        entities.append(Entity("spoiler", txt))
+                    elif tag == "a" and node.has_attr("href"):
+                        entities.append(Entity("text_link", txt, href=node["href"]))
                     else:
-                        entities.append({"type": etype or "plain", "text": txt})
-                        return
+                        entities.append(Entity(etype or "plain", txt))
 
-            for child in text_div.contents:
+            for child in txt_div.contents:
                 walk(child)
 
-            has_formatting = any(e["type"] != "plain" for e in entities)
-
-            if has_formatting:
-                text_list = [dict(e) for e in entities]
-                text_list.append("")  # Required empty element
-                msg["text"] = text_list
-
-                te = [dict(e) for e in entities]
-                te.append({"type": "plain", "text": ""})
-                msg["text_entities"] = te
+            # If there is at least one non-plain element, we consider it formatting
+            has_fmt = any(e.type != "plain" for e in entities)
 
+            if has_fmt:
+                msg["text"] = entities + [""]
+                msg["text_entities"] = entities + [Entity("plain", "")]
             else:
+                # All plain - one element with text
                 msg["text"] = full_text
-                msg["text_entities"] = entities
-        else:
-            msg["text"] = ""
-            msg["text_entities"] = []
-
-        # reply
-        rep = div.find("div", class_="reply_to")
-        if rep:
-            a = rep.find("a", onclick=True)
-            if a:
-                mid = a["onclick"].split("(")[1].split(")")[0]
-                msg["reply_to_message_id"] = int(mid)
-
-        # Location
-        loc_a = div.find("a", class_="media_location")
-        if loc_a and "q=" in loc_a["href"]:
-            coords = loc_a["href"].split("q=")[1].split("&")[0].split(",")
-            msg["location_information"] = {
-                "latitude": float(coords[0]),
-                "longitude": float(coords[1]),
-            }
-            msg["text"] = ""
-            msg["text_entities"] = []
-            messages.append(msg)
-            continue
+                msg["text_entities"] = [Entity("plain", full_text)]
 
-        # Forward
-        fwd = div.find("div", class_="forwarded body")
-        if fwd:
-            # Forward name
-            orig = fwd.find("div", class_="from_name")
-            if orig:
-                for span in orig.find_all("span"):
-                    span.decompose()
-                msg["forwarded_from"] = orig.get_text(strip=True)
-                msg["from"]    = name
-                msg["from_id"] = uid
-
-            # Forward media
-            media_wrap = fwd.find("div", class_="media_wrap")
-            if media_wrap:
-                link = media_wrap.find("a", href=True)
-                if link:
-                    href = link["href"]
-                    if href.startswith("http"):
-                        msg["file"] = href
-                    else:
-                        fp = export_dir / href
-                        info = get_file_info(fp, export_dir)
-                        if info:
-                            msg.update(info)
-
-            # Forward text with tags (without empty newline)
-            txt_div = fwd.find("div", class_="text")
-            if txt_div:
-                full_text = ""
-                entities = []
-                TAG_MAP = {
-                    "strong": "bold", "em": "italic", "u": "underline", "s": "strikethrough",
-                    "blockquote": "blockquote", "pre": "pre", "span": "spoiler", "a": "text_link"
-                }
-
-                def walk(node):
-                    nonlocal full_text, entities
-                    # plain text (hard discard nodes where txt.strip() is empty)
-                    if isinstance(node, NavigableString):
-                        raw = str(node)
-                        txt = raw.replace("\n", "")
-                        if not txt.strip():
-                            return
-                        full_text += txt
-                        entities.append({"type": "plain", "text": txt})
-                    # <br> skip (or can be converted to \n – optional)
-                    elif isinstance(node, Tag) and node.name == "br":
-                        # if need comment \n:
-                        # full_text += "\n"
-                        return
-                    # Formatting tags
-                    elif isinstance(node, Tag):
-                        tag = node.name
-                        if tag == "span" and node.get("aria-hidden") == "true":
-                            etype = "spoiler"
-                        else:
-                            etype = TAG_MAP.get(tag)
-                        txt = node.get_text().replace("\n", "")
-                        if not txt:
-                            return
-                        full_text += txt
-                        if etype == "pre":
-                            entities.append({"type": "pre", "text": txt, "language": ""})
-                        elif etype == "blockquote":
-                            entities.append({"type": "blockquote", "text": txt, "collapsed": False})
-                        elif etype == "spoiler":
-                            entities.append({"type": "spoiler", "text": txt})
-                        elif tag == "a" and node.has_attr("href"):
-                            entities.append({"type": "text_link", "text": txt, "href": node["href"]})
-                        else:
-                            entities.append({"type": etype or "plain", "text": txt})
-
-                for child in txt_div.contents:
-                    walk(child)
-
-                # If there is at least one non-plain element, we consider it formatting
-                has_fmt = any(e["type"] != "plain" for e in entities)
-
-                if has_fmt:
-                    msg["text"] = [dict(e) for e in entities] + [""]
-                    msg["text_entities"] = [dict(e) for e in entities] + [{"type": "plain", "text": ""}]
-                else:
-                    # All plain - one element with text
-                    msg["text"] = full_text
-                    msg["text_entities"] = [{"type": "plain", "text": full_text}]
+        return msg
 
-            messages.append(msg)
+    # files
+    for a in div.find_all("a", href=True):
+        if a.find_parent("div", class_="text"):
             continue
+        href = a["href"]
+        if href.startswith("http"):
+            add_file_link(msg, href)
+        else:
+            add_media(msg, export_dir / href, export_dir)
 
-        # files
-        for a in div.find_all("a", href=True):
-            if a.find_parent("div", class_="text"):
-                continue
-            href = a["href"]
-            if href.startswith("http"):
-                msg["file"] = href
-            else:
-                fp = export_dir / href
-                info = get_file_info(fp, export_dir)
-                if info:
-                    msg.update(info)
-
-        # Location
-        extract_location(div, msg)
+    # Location
+    extract_location(div, msg)
 
-        messages.append(msg)
-    return messages
+    return msg
 
-def convert(html_file, output_file, export_dir, chat_name, chat_id):
-    last_sender = {}
-    msgs = parse_html_to_messages(html_file, export_dir, last_sender)
-    # No more calls/parse_calls_from_html needed
-    msgs_od = [order_message(m) for m in sorted(msgs, key=lambda m: m["id"])]
-    data = OrderedDict([
+def parse_html_to_messages(html_path: pathlib.Path, export_dir: pathlib.Path, last_sender: dict,
+                           parser: str = "html.parser"):
+    messages = []
+    dates = DateFiller()
+    soup = make_soup(html_path.read_text(encoding="utf-8"), parser)
+    for div in soup.find_all("div", class_="message"):
+        msg = parse_message_div(div, export_dir, last_sender, dates)
+        if msg is not None:
+            messages.append(msg)
+    # Probes submitted by the walk above are finished in the meantime
+    return [resolve_media(msg) for msg in messages]
+
+# Start of every div.message in an export page
+MESSAGE_START = re.compile(r'<div class="message[\s"]')
+
+def iter_message_chunks(html_path: pathlib.Path, block_size: int = 1 << 20):
+    # The html of every div.message of the page, read block by block
+    with html_path.open(encoding="utf-8") as f:
+        buf = ""
+        started = False
+        while True:
+            block = f.read(block_size)
+            buf += block
+            if not started:
+                m = MESSAGE_START.search(buf)
+                if not m:
+                    if not block:
+                        return
+                    # Page header: keep only what may be a cut "<div class="message"
+                    buf = buf[-32:]
+                    continue
+                buf = buf[m.start():]
+                started = True
+            # Every next message start closes the previous chunk
+            pos = 0
+            for m in MESSAGE_START.finditer(buf, 1):
+                yield buf[pos:m.start()]
+                pos = m.start()
+            buf = buf[pos:]
+            if not block:
+                # The last chunk also holds the closing tags of the page
+                yield buf
+                return
+
+def read_chat_name(html_path: pathlib.Path, parser: str = "html.parser"):
+    # The chat name is in the page header, before the first message
+    head = ""
+    with html_path.open(encoding="utf-8") as f:
+        while True:
+            block = f.read(1 << 16)
+            head += block
+            m = MESSAGE_START.search(head)
+            if m:
+                head = head[:m.start()]
+                break
+            if not block:
+                break
+    return make_soup(head, parser).select_one(".page_header .text.bold").get_text(strip=True)
+
+def iter_messages_streaming(html_path: pathlib.Path, export_dir: pathlib.Path, last_sender: dict,
+                            parser: str = "html.parser"):
+    # parse_html_to_messages one div.message at a time: memory does not grow with the page
+    dates = DateFiller()
+    held = []
+    for chunk in iter_message_chunks(html_path):
+        div = make_soup(chunk, parser).find("div", class_="message")
+        if div is None:
+            continue
+        msg = parse_message_div(div, export_dir, last_sender, dates)
+        if msg is not None:
+            held.append(msg)
+        if not dates.waiting:
+            yield from held
+            held = []
+    yield from held
+
+# --split: pages are cut in chunks of at least this size, up to 4 per process
+SPLIT_CHUNK = 1 << 20
+
+# Set by main with --split, None = every page parsed in one piece
+split_pool = None
+split_jobs = 1
+
+def open_split_pool(jobs, cache_path=None, cache_hash=False, probe_threads=0):
+    global split_pool, split_jobs
+    split_jobs = jobs
+    split_pool = None
+    if jobs > 1:
+        split_pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                         initargs=(cache_path, cache_hash, probe_threads, export_index, profiling.enabled))
+    return split_pool
+MESSAGE_START_BYTES = re.compile(MESSAGE_START.pattern.encode())
+
+class ChunkDates(DateFiller):
+    # DateFiller of a page chunk: its undated head gets the last date of the chunks before, when known
+    def __init__(self):
+        super().__init__()
+        self.first = None
+        self.head = []
+
+    def seen(self, date):
+        if self.first is None:
+            self.first = date
+            self.head = list(self.waiting)
+        super().seen(date)
+
+def split_points(html_path: pathlib.Path, parts: int):
+    # [(start, end)] byte ranges of up to "parts" chunks of the page, each starting at a div.message
+    with html_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        first = MESSAGE_START_BYTES.search(mm)
+        if not first:
+            return []
+        offsets = [first.start()]
+        for i in range(1, parts):
+            m = MESSAGE_START_BYTES.search(mm, max(offsets[-1] + 1, len(mm) * i // parts))
+            if not m:
+                break
+            if m.start() > offsets[-1]:
+                offsets.append(m.start())
+        offsets.append(len(mm))
+    return list(zip(offsets, offsets[1:]))
+
+def _parse_chunk(html_path, start, end, export_dir, parser, last_sender):
+    # Runs in a --split worker: the messages of html_path[start:end], media resolved
+    STATS.clear()
+    profiling.clear()
+    with html_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode("utf-8")
+    dates = ChunkDates()
+    msgs = []
+    starts = [m.start() for m in MESSAGE_START.finditer(text)] + [len(text)]
+    for a, b in zip(starts, starts[1:]):
+        div = make_soup(text[a:b], parser).find("div", class_="message")
+        if div is None:
+            continue
+        msg = parse_message_div(div, export_dir, last_sender, dates)
+        if msg is not None:
+            msgs.append(msg)
+    head = {id(m) for m in (dates.head if dates.first else dates.waiting)}
+    head = [i for i, m in enumerate(msgs) if id(m) in head]
+    msgs = [resolve_media(m) for m in msgs]
+    return msgs, last_sender, head, dates.first, dates.last, dict(STATS), profiling.snapshot()
+
+def _inherit_sender(msg: dict, sender: dict):
+    for key, value in msg.items():
+        if value == INHERITED_SENDER["name"]:
+            msg[key] = sender.get("name", "Unknown")
+        elif value == INHERITED_SENDER["from_id"]:
+            msg[key] = sender.get("from_id", "Unknown")
+
+def iter_messages_parallel(html_path: pathlib.Path, export_dir: pathlib.Path, last_sender: dict,
+                           parser: str, pool, parts: int):
+    # iter_messages_streaming with the page cut in "parts" chunks parsed on "pool", stitched in order
+    futures = [
+        pool.submit(_parse_chunk, html_path, start, end, export_dir, parser,
+                    dict(last_sender) if i == 0 else dict(INHERITED_SENDER))
+        for i, (start, end) in enumerate(split_points(html_path, parts))
+    ]
+    last_date = None
+    waiting = []   # undated messages with no date before them yet
+    held = []
+    for i, fut in enumerate(futures):
+        msgs, tail, head, first_date, chunk_last, stats, profile = fut.result()
+        STATS.update(stats)
+        profiling.merge(profile)
+        if i > 0:
+            for msg in msgs:
+                _inherit_sender(msg, last_sender)
+            if tail.get("name") == INHERITED_SENDER["name"]:
+                tail = dict(last_sender)
+        last_sender.clear()
+        last_sender.update(tail)
+        head = [msgs[j] for j in head]
+        if last_date:
+            for msg in head:
+                msg["date"], msg["date_unixtime"] = last_date
+        elif first_date is None:
+            waiting.extend(head)
+        if first_date and waiting:
+            for msg in waiting:
+                msg["date"], msg["date_unixtime"] = first_date
+            waiting = []
+        last_date = chunk_last or last_date
+        held.extend(msgs)
+        if not waiting:
+            yield from held
+            held = []
+    yield from held
+
+def split_parts(html_path: pathlib.Path):
+    # Chunks to cut the page in for split_pool (1: not worth splitting)
+    if split_pool is None:
+        return 1
+    return max(1, min(split_jobs * 4, html_path.stat().st_size // SPLIT_CHUNK))
+
+def write_chat_json(output_file: pathlib.Path, chat_name, chat_id, messages, fmt="pretty"):
+    # Written message by message, so "messages" may be a generator
+    header = OrderedDict([
         ("name", chat_name),
         ("type", "personal_chat"),
         ("id", chat_id),
-        ("messages", msgs_od),
     ])
+    written = 0
+    # Without indent json uses its C encoder: much faster
+    compact = functools.partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
     with output_file.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+        if fmt == "jsonl":
+            f.write(compact(header) + "\n")
+            for msg in messages:
+                f.write(compact(order_message(msg)) + "\n")
+            return
+        if fmt == "compact":
+            f.write(compact(header)[:-1] + ',"messages":[')
+            for msg in messages:
+                f.write(("," if written else "") + compact(order_message(msg)))
+                written += 1
+            f.write("]}")
+            return
+        # Same text as json.dump(..., indent=4) of the whole chat
+        header = json.dumps(header, ensure_ascii=False, indent=4)
+        sep = "\n        "
+        f.write(header[:-2] + ',\n    "messages": [')
+        for msg in messages:
+            text = json.dumps(order_message(msg), ensure_ascii=False, indent=4)
+            f.write(("," if written else "") + sep + text.replace("\n", sep))
+            written += 1
+        f.write("\n    ]\n}" if written else "]\n}")
+
+def convert(html_file, output_file, export_dir, chat_name, chat_id, last_sender=None,
+            parser="html.parser", stream=False, fmt="pretty"):
+    # "last_sender" is carried over from the previous html file, so that
+    # a page starting with "joined" messages keeps the right sender
+    if last_sender is None:
+        last_sender = {}
+    parts = split_parts(html_file)
+    if parts > 1:
+        msgs = profiling.timed(iter_messages_parallel(html_file, export_dir, last_sender, parser, split_pool, parts),
+                               "parse", "messages")
+        if not stream:
+            msgs = sorted(msgs, key=lambda m: m["id"])
+    elif stream:
+        # Written as they are parsed, in page order (Telegram writes them in id order)
+        msgs = profiling.timed(iter_messages_streaming(html_file, export_dir, last_sender, parser), "parse", "messages")
+        msgs = profiling.timed(resolve_media_in_order(msgs), "media_wait")
+    else:
+        with profiling.stage("parse"):
+            msgs = parse_html_to_messages(html_file, export_dir, last_sender, parser)
+        profiling.count("messages", len(msgs))
+        # No more calls/parse_calls_from_html needed
+        msgs = sorted(msgs, key=lambda m: m["id"])
+    with profiling.stage("write_json"):
+        write_chat_json(output_file, chat_name, chat_id, msgs, fmt)
+
+# Sender used by a parallel worker until the file's first "from_name": the
+# real one is only known when the previous file is done, so it is patched
+# into the output JSON afterwards
+INHERITED_SENDER = {"name": "\x00inherited_name\x00", "from_id": "\x00inherited_from_id\x00"}
+
+def _init_worker(cache_path, cache_hash, probe_threads, index, profile=False):
+    global export_index, split_pool, split_jobs
+    export_index = index
+    # A forked worker inherits the parent's --split pool, which it cannot use
+    split_pool, split_jobs = None, 1
+    profiling.enabled = profile
+    open_media_cache(cache_path, cache_hash)
+    open_media_pool(probe_threads)
+
+def _convert_job(html_file, output_file, export_dir, chat_name, chat_id, first, parser, stream, fmt):
+    STATS.clear()
+    profiling.clear()
+    last_sender = {} if first else dict(INHERITED_SENDER)
+    convert(html_file, output_file, export_dir, chat_name, chat_id, last_sender, parser, stream, fmt)
+    return last_sender, dict(STATS), profiling.snapshot()
+
+def patch_inherited_sender(output_file: pathlib.Path, sender: dict):
+    replace = {
+        json.dumps(INHERITED_SENDER[k]): json.dumps(sender.get(k, "Unknown"), ensure_ascii=False)
+        for k in ("name", "from_id")
+    }
+    keep = max(len(k) for k in replace) - 1
+    tmp = output_file.with_name(output_file.name + ".tmp")
+    changed = False
+    with output_file.open(encoding="utf-8") as src, tmp.open("w", encoding="utf-8") as dst:
+        tail = ""
+        while True:
+            block = src.read(1 << 20)
+            buf = tail + block
+            for old, new in replace.items():
+                if old in buf:
+                    buf = buf.replace(old, new)
+                    changed = True
+            if not block:
+                dst.write(buf)
+                break
+            # Keep the end of the buffer: a placeholder may be cut by the block border
+            dst.write(buf[:-keep])
+            tail = buf[-keep:]
+    if changed:
+        os.replace(tmp, output_file)
+    else:
+        tmp.unlink()
+
+# Bump when the converter starts writing something else for the same html
+CONVERTER_VERSION = 1
+
+class Manifest:
+    # What the previous runs converted (stat, hash, output and senders per html file), dropped when the options change
+    def __init__(self, path: pathlib.Path, options: dict, reset: bool = False):
+        self.path = path
+        self.options = options
+        self.files = {}
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        if not reset and data.get("version") == CONVERTER_VERSION and data.get("options") == options:
+            self.files = data.get("files", {})
+
+    def is_clean(self, html: pathlib.Path, output: pathlib.Path, sender_in=None):
+        # sender_in=None: only the files are checked, not the inherited sender
+        entry = self.files.get(html.name)
+        if not entry or entry["output"] != output.name:
+            return False
+        if sender_in is not None and entry["sender_in"] != sender_in:
+            return False
+        try:
+            st, out_st = html.stat(), output.stat()
+        except OSError:
+            return False
+        if (out_st.st_size, out_st.st_mtime_ns) != (entry["output_size"], entry["output_mtime_ns"]):
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns != entry["mtime_ns"]:
+            # Touched or copied, but maybe not changed
+            if file_hash(html) != entry["hash"]:
+                return False
+            entry["mtime_ns"] = st.st_mtime_ns
+        return True
+
+    def sender_out(self, html: pathlib.Path):
+        return self.files[html.name]["sender_out"]
+
+    def record(self, html: pathlib.Path, output: pathlib.Path, sender_in: dict, sender_out: dict):
+        st, out_st = html.stat(), output.stat()
+        self.files[html.name] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "hash": file_hash(html),
+            "output": output.name,
+            "output_size": out_st.st_size,
+            "output_mtime_ns": out_st.st_mtime_ns,
+            "sender_in": sender_in,
+            "sender_out": sender_out,
+        }
+
+    def save(self, htmls):
+        names = {html.name for html in htmls}
+        data = {
+            "version": CONVERTER_VERSION,
+            "options": self.options,
+            "files": {name: entry for name, entry in self.files.items() if name in names},
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+def convert_parallel(htmls, export_dir, chat_name, chat_id, jobs, parser="html.parser", stream=False,
+                     cache_path=None, cache_hash=False, probe_threads=0, fmt="pretty", manifest=None):
+    # Convert the html files (those changed since "manifest", if given) on a process pool
+    outs = [html.with_suffix(FORMATS[fmt]) for html in htmls]
+    tails = [None] * len(htmls)
+    senders_in = [{}] * len(htmls)
+    dirty = set(range(len(htmls)))
+    if manifest is not None:
+        for i, (html, out) in enumerate(zip(htmls, outs)):
+            if manifest.is_clean(html, out):
+                tails[i] = manifest.sender_out(html)
+                dirty.discard(i)
+    stitched = 0
+    inherited = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(cache_path, cache_hash, probe_threads, export_index, profiling.enabled)) as pool:
+        futures = {
+            pool.submit(_convert_job, htmls[i], outs[i], export_dir, chat_name, chat_id, i == 0, parser, stream, fmt): i
+            for i in sorted(dirty)
+        }
+        done = 0
+        for fut in as_completed(futures):
+            i = futures[fut]
+            tails[i], stats, profile = fut.result()
+            STATS.update(stats)
+            profiling.merge(profile)
+            done += 1
+            print(f"✅ {htmls[i].name} → {outs[i].name} ({done}/{len(futures)})")
+            # Resolve "last_sender" for every file whose predecessors are all finished
+            while stitched < len(htmls) and tails[stitched] is not None:
+                tail = tails[stitched]
+                if stitched in dirty:
+                    if stitched > 0:
+                        patch_inherited_sender(outs[stitched], inherited)
+                        senders_in[stitched] = dict(inherited)
+                    # A file without any "from_name" passes the sender through
+                    if tail.get("name") == INHERITED_SENDER["name"]:
+                        tail = dict(inherited)
+                    if manifest is not None:
+                        manifest.record(htmls[stitched], outs[stitched], senders_in[stitched], tail)
+                inherited = tail
+                stitched += 1
+    return len(futures)
+
+def write_result(export_dir: pathlib.Path, outs, fmt="pretty"):
+    # result.json (or .jsonl) for import.py, merged from the per-page outputs
+    result = export_dir / ("result" + FORMATS[fmt])
+    if result.exists() and all(out.stat().st_mtime_ns <= result.stat().st_mtime_ns for out in outs):
+        print(f"{result.name} is up to date")
+        return
+    count, _ = merge.merge_files(outs, result, fmt=fmt)
+    print(f"✅ {len(outs)} files → {result.name} ({count} messages)")
+
+def iter_export(export_dir: pathlib.Path, parser="html.parser", probe_threads=8, use_cache=True):
+    # Every message of the export, one at a time, as --stream would write them (for import.py --html)
+    open_media_cache(export_dir / ".media_cache.sqlite" if use_cache else None)
+    open_media_pool(probe_threads)
+    open_export_index(export_dir)
+    last_sender = {}
+    for html in sorted(export_dir.glob("messages*.html"), key=html_sort_key):
+        yield from resolve_media_in_order(iter_messages_streaming(html, export_dir, last_sender, parser))
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--path", required=True, help="Path to Telegram export folder")
     parser.add_argument("--chat_id", required=True, type=int, help="Chat ID")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of html files converted in parallel (0 = all CPU cores)")
+    parser.add_argument("--parser", choices=PARSERS, default="html.parser",
+                        help="HTML parser backend (lxml is much faster, requires 'pip install lxml')")
+    parser.add_argument("--stream", action="store_true",
+                        help="Parse and write messages one at a time (memory stays flat on huge pages)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not use the media info cache (.media_cache.sqlite in the export folder)")
+    parser.add_argument("--clear-cache", action="store_true", help="Empty the media info cache before converting")
+    parser.add_argument("--cache-hash", action="store_true",
+                        help="Also match cached media by content hash, when only the mtime has changed")
+    parser.add_argument("--format", choices=FORMATS, default="pretty",
+                        help="Output: indented json (pretty), json without whitespace (compact) "
+                             "or one message per line (jsonl, written to messages*.jsonl)")
+    parser.add_argument("--full", action="store_true",
+                        help="Convert every html file, even those unchanged since the last run")
+    parser.add_argument("--result", action="store_true",
+                        help="Also merge the outputs into result.json")
+    parser.add_argument("--probe-threads", type=int, default=8,
+                        help="Threads probing media files while the html is parsed (0 = probe inline)")
+    parser.add_argument("--split", type=int, default=1,
+                        help="Processes parsing each html file, cut at message boundaries "
+                             "(for a single huge messages.html; 0 = all CPU cores)")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="Write the time of every stage (parsing, probes, JSON writing...) and counters to this JSON file")
+    parser.add_argument("--cprofile", metavar="FILE", help="With --profile, also write a cProfile dump (pstats) to FILE")
     args = parser.parse_args()
+    if args.profile:
+        profiling.start(args.profile, args.cprofile)
 
     export_dir = pathlib.Path(args.path)
-    soup = BeautifulSoup((export_dir/"messages.html").read_text(encoding="utf-8"), "html.parser")
-    chat_name = soup.select_one(".page_header .text.bold").get_text(strip=True)
-    for html in sorted(export_dir.glob("messages*.html")):
-        out = html.with_suffix(".json")
-        convert(html, out, export_dir, chat_name, args.chat_id)
+    if not (export_dir / "messages.html").is_file():
+        sys.exit(f"No messages.html in {export_dir}")
+    cache_path = None if args.no_cache else export_dir / ".media_cache.sqlite"
+    cache = open_media_cache(cache_path, args.cache_hash)
+    if cache and args.clear_cache:
+        cache.clear()
+    open_media_pool(args.probe_threads)
+    open_export_index(export_dir)
+    open_split_pool(args.split or os.cpu_count() or 1, cache_path, args.cache_hash, args.probe_threads)
+    chat_name = read_chat_name(export_dir/"messages.html", args.parser)
+    htmls = sorted(export_dir.glob("messages*.html"), key=html_sort_key)
+    outs = [html.with_suffix(FORMATS[args.format]) for html in htmls]
+    # Anything that changes the output: a change converts every file again
+    options = {"chat_name": chat_name, "chat_id": args.chat_id, "format": args.format, "stream": args.stream,
+               "sender_map": sender_map}
+    manifest = Manifest(export_dir / ".convert_manifest.json", options, reset=args.full)
+    jobs = args.jobs or os.cpu_count() or 1
+    converted = 0
+    if jobs > 1 and len(htmls) > 1:
+        converted = convert_parallel(htmls, export_dir, chat_name, args.chat_id, jobs, args.parser, args.stream,
+                         cache_path, args.cache_hash, args.probe_threads, args.format, manifest)
+    # Sequential run; after a parallel one, it only redoes the files whose
+    # inherited sender changed because a file before them was converted
+    last_sender = {}
+    for html, out in zip(htmls, outs):
+        sender_in = dict(last_sender)
+        if manifest.is_clean(html, out, sender_in):
+            last_sender = dict(manifest.sender_out(html))
+            continue
+        convert(html, out, export_dir, chat_name, args.chat_id, last_sender, args.parser, args.stream,
+                args.format)
+        manifest.record(html, out, sender_in, dict(last_sender))
+        converted += 1
         print(f"✅ {html.name} → {out.name}")
+    manifest.save(htmls)
+    if not converted:
+        print(f"Nothing changed since the last run ({len(htmls)} files, --full to convert them all)")
+    if args.result:
+        with profiling.stage("merge"):
+            write_result(export_dir, outs, args.format)
+    if cache:
+        print(f"Media cache: {STATS['cache_hits']} hits, {STATS['cache_misses']} misses")
+    print(f"Media probes: {STATS['subprocesses']} ffprobe runs, {STATS['moviepy_clips']} moviepy clips")
+    if split_pool is not None:
+        split_pool.shutdown()
+    profiling.finish({"converted": converted, "stats": dict(STATS)})
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Import of a Telegram chat in JSON format via Telethon (Sync API).
+Import of a Telegram chat in JSON format via Telethon (asyncio API).
 Extended import with the latest changes:
 
     Pinned messages display the text of the pinned message.
@@ -16,27 +16,62 @@ Extended import with the latest changes:
     Forwarded messages from channels retain the text.
 
     Forwards with attachments display a text caption under the attachment.
+
+    Media files are uploaded several at a time, as many as the server accepts
+    without FloodWaits (--concurrency is the upper bound), largest first, and
+    the upload time is estimated before it starts. The parts of a file are
+    sent several at a time (--part-parallel, --part-size).
+
+    Media files with the same content (stickers, forwarded photos saved
+    under other names) are uploaded once (--no-dedup to upload every copy).
+
+    With --html, the messages*.html of the export are read directly with
+    converter.py's parser: no messages*.json or result.json is written
+    (--save-result to keep a result.jsonl anyway).
 """
 import argparse
+import asyncio
+import hashlib
+import heapq
 import json
 import math
 import mimetypes
+import mmap
 import os
+import random
+import re
 import tempfile
+import time
 import pathlib
 import sys
-from dateutil.parser import parse as parse_dt
-from telethon.sync import TelegramClient
-from telethon import functions, types
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from itertools import islice
+from telethon import TelegramClient, errors, functions, types, utils
 from tqdm import tqdm
+try:
+    import stage_profile as profiling
+except ImportError:
+    sys.exit('stage_profile.py must be next to import.py')
 
 
 def _fmt_date(msg):
+    date = msg.get('date', '')
+    # converter.py writes "%Y-%m-%dT%H:%M:%S": fromisoformat reads it far faster than dateutil,
+    # which is kept for the other forms
     try:
-        dt = parse_dt(msg.get('date', ''))
-        return dt.strftime('%d/%m/%y, %H:%M')
-    except:
-        return ''
+        dt = datetime.fromisoformat(date)
+        if date[4:5] == '-' and date[10:11] == 'T' and date[13:14] == ':':
+            # A valid "YYYY-MM-DDTHH:MM...": the parts are already there
+            return f'{date[8:10]}/{date[5:7]}/{date[2:4]}, {date[11:16]}'
+    except (TypeError, ValueError):
+        try:
+            from dateutil.parser import parse as parse_dt
+            dt = parse_dt(date)
+        except:
+            return ''
+    return f'{dt.day:02d}/{dt.month:02d}/{dt.year % 100:02d}, {dt.hour:02d}:{dt.minute:02d}'
 
 
 def _fmt_text(msg):
@@ -46,24 +81,61 @@ def _fmt_text(msg):
     return msg.get('text','') or ''
 
 
-def convert_json_to_whatsapp_format(data, only_n=math.inf):
-    raw_msgs = data.get('messages', [])
-    # Pre-filling citation dictionaries
-    id_to_content = {}
-    id_to_date = {}
-    for m in raw_msgs:
-        mid = m.get('id')
-        id_to_date[mid] = _fmt_date(m)
-        fp = m.get('file') or m.get('photo') or m.get('contact_vcard')
-        if fp:
-            id_to_content[mid] = pathlib.Path(fp).name
-        else:
-            id_to_content[mid] = _fmt_text(m)
+def _limit(only_n):
+    # --only-first as an islice stop (None = all the messages)
+    return int(only_n) if isinstance(only_n, (int,float)) and math.isfinite(only_n) else None
+
+
+def quoted_id(m):
+    # Id of the message quoted by a reply or a pin (None otherwise)
+    if m.get('type') == 'service':
+        return m.get('message_id') if m.get('action') == 'pin_message' else None
+    return m.get('reply_to_message_id') or None
 
-    msgs = raw_msgs[:int(only_n)] if isinstance(only_n, (int,float)) and math.isfinite(only_n) else raw_msgs
-    lines = []
-    filelist = {}
 
+def referenced_ids(messages):
+    # Ids of the messages quoted by a reply or a pin
+    refs = {quoted_id(m) for m in messages}
+    refs.discard(None)
+    return refs
+
+
+def reply_index(messages, refs):
+    # {id: (content, date)} of the quoted messages ("refs") only, for the reply and pin lines
+    index = {}
+    for m in messages:
+        if m.get('id') in refs:
+            index[m['id']] = _quote(m)
+    return index
+
+
+def _quote(m):
+    fp = m.get('file') or m.get('photo') or m.get('contact_vcard')
+    return (pathlib.Path(fp).name if fp else _fmt_text(m), _fmt_date(m))
+
+
+def indexed(messages, refs, ahead, index):
+    # "messages", adding the quoted ones to "index" as they go by. A reply or pin quoting
+    # one of "ahead" (further on) is held back, with the messages after it, until it is indexed
+    held = []
+    awaited = set()
+    for m in messages:
+        mid = m.get('id')
+        if mid in refs:
+            index[mid] = _quote(m)
+            awaited.discard(mid)
+        qid = quoted_id(m)
+        if qid in ahead and qid not in index:
+            awaited.add(qid)
+        held.append(m)
+        if not awaited:
+            yield from held
+            held = []
+    yield from held
+
+
+def iter_whatsapp_lines(msgs, index, filelist):
+    # The import text lines of "msgs", one at a time; media files are added to "filelist"
     for msg in msgs:
         mtype = msg.get('type')
         # Service-messages
@@ -74,8 +146,8 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
             action = msg.get('action','')
             if action == 'pin_message':
                 pid = msg.get('message_id')
-                orig = id_to_content.get(pid,'')
-                lines.append(f"{prefix}The message was pinned: '{orig}'\n")
+                orig = index.get(pid, ('', ''))[0]
+                yield f"{prefix}The message was pinned: '{orig}'\n"
             else:
                 svc_map = {
                     'clear_history': 'History cleared',
@@ -83,7 +155,7 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
                     'phone_call': f"Call ({msg.get('discard_reason','')}, duration {msg.get('duration_seconds',0)}s)"
                 }
                 text = svc_map.get(action, action)
-                lines.append(f"{prefix}{text}\n")
+                yield f"{prefix}{text}\n"
             continue
 
         # Regular messages and media
@@ -93,18 +165,17 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
 
         # Replies
         if rid := msg.get('reply_to_message_id'):
-            orig = id_to_content.get(rid,'')
-            orig_time = id_to_date.get(rid,'')
-            lines.append(f"{prefix}You replied to the message: '{orig}' ({orig_time})\n")
+            orig, orig_time = index.get(rid, ('', ''))
+            yield f"{prefix}You replied to the message: '{orig}' ({orig_time})\n"
             reply = _fmt_text(msg)
             if reply:
-                lines.append(f"{prefix}{reply}\n")
+                yield f"{prefix}{reply}\n"
             continue
 
         # Contact
         if info := msg.get('contact_information'):
             text = f"Contact: {info.get('first_name','')} {info.get('last_name','')} {info.get('phone_number','')}"
-            lines.append(f"{prefix}{text}\n")
+            yield f"{prefix}{text}\n"
             continue
 
         # Poll
@@ -112,13 +183,13 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
             q = poll.get('question','')
             opts = [ans['text'] for ans in poll.get('answers',[])]
             text = f"Poll: {q} [{', '.join(opts)}]"
-            lines.append(f"{prefix}{text}\n")
+            yield f"{prefix}{text}\n"
             continue
 
         # Geolocation
         if loc := msg.get('location_information'):
             url = f"https://www.google.com/maps/search/?api=1&query={loc['latitude']},{loc['longitude']}"
-            lines.append(f"{prefix}{url}\n")
+            yield f"{prefix}{url}\n"
             continue
 
         # Attachments and forward
@@ -126,7 +197,7 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
         if fp and not (str(fp).startswith('http://') or str(fp).startswith('https://')):
             # Forward label, if any
             if fwd := msg.get('forwarded_from'):
-                lines.append(f"{prefix}[Forwarded from {fwd}]\n")
+                yield f"{prefix}[Forwarded from {fwd}]\n"
             fn = pathlib.Path(fp).name
             attr = {'filename': fn, 'media_type': msg.get('media_type'), 'is_photo': bool(msg.get('photo'))}
             for a in ('duration_seconds','width','height','file_size','thumbnail','thumbnail_file_size'):
@@ -134,11 +205,11 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
                     attr[a] = msg[a]
             filelist[fp] = attr
             # Attachment as a separate message
-            lines.append(f"{prefix}{fn} (file attached)\n")
+            yield f"{prefix}{fn} (file attached)\n"
             # Caption for the attachment
             caption = _fmt_text(msg)
             if caption:
-                lines.append(f"{prefix}{caption}\n")
+                yield f"{prefix}{caption}\n"
             continue
 
         # Other text and forward in the text
@@ -148,16 +219,127 @@ def convert_json_to_whatsapp_format(data, only_n=math.inf):
         parts.append(_fmt_text(msg))
         text = ''.join(parts).strip()
         if text:
-            lines.append(f"{prefix}{text}\n")
+            yield f"{prefix}{text}\n"
 
+
+def convert_json_to_whatsapp_format(data, only_n=math.inf):
+    # The whole chat in memory: (lines, filelist)
+    raw_msgs = data.get('messages', [])
+    index = reply_index(raw_msgs, referenced_ids(islice(raw_msgs, _limit(only_n))))
+    filelist = {}
+    lines = list(iter_whatsapp_lines(islice(raw_msgs, _limit(only_n)), index, filelist))
     return lines, filelist
 
 
-def upload_file(client, peer, imp_id, base_path, rel_path, info):
-    path = base_path / rel_path
+def chat_messages(path: pathlib.Path):
+    # The messages of result.json / result.jsonl, read one by one
+    from merge import read_messages
+    return read_messages(chat_file(path), {})
+
+
+def forward_quotes(messages, limit):
+    # One pass: the ids quoted by the first "limit" messages, and {id: quote} of those that
+    # come after a reply or pin to them (the others are indexed as they go by, see indexed)
+    refs, index = set(), {}
+    for i, m in enumerate(messages):
+        mid = m.get('id')
+        if mid in refs and mid not in index:
+            index[mid] = _quote(m)
+        if limit is None or i < limit:
+            if (qid := quoted_id(m)) is not None:
+                refs.add(qid)
+    return refs, index
+
+
+def prepare_chat(path: pathlib.Path, only_n=math.inf, out=None):
+    # Stream the chat into import lines (to "out" if given): returns (the first 100 lines, filelist).
+    # The chat file is read twice: the quoted ids, then the lines
+    refs, index = forward_quotes(chat_messages(path), _limit(only_n))
+    filelist = {}
+    messages = profiling.timed(chat_messages(path), 'read_json', 'messages')
+    messages = indexed(messages, refs, (), index)
+    head = write_lines(iter_whatsapp_lines(islice(messages, _limit(only_n)), index, filelist), out)
+    return head, filelist
+
+
+def write_lines(lines, out):
+    # The first 100 lines are kept for CheckHistoryImportRequest
+    head = []
+    for line in lines:
+        if len(head) < 100:
+            head.append(line)
+        if out is not None:
+            out.write(line)
+    return head
+
+
+QUOTE_LINK = re.compile(r'GoToMessage\((\d+)\)')
+MESSAGE_ID = re.compile(r'id="message(-?\d+)"')
+
+
+def html_files(path: pathlib.Path):
+    from converter import html_sort_key
+    htmls = sorted(path.glob('messages*.html'), key=html_sort_key)
+    if not htmls:
+        sys.exit(f'No messages*.html in {path}')
+    return htmls
+
+
+def html_references(htmls):
+    # Ids behind the reply and pin links, found a div.message at a time without parsing the html,
+    # and those of them that come after a link to them: (refs, ahead)
+    from converter import iter_message_chunks
+    refs, pending, ahead = set(), set(), set()
+    for html in htmls:
+        for chunk in iter_message_chunks(html):
+            if m := MESSAGE_ID.search(chunk):
+                mid = int(m.group(1))
+                if mid in pending:
+                    pending.discard(mid)
+                    ahead.add(mid)
+            for link in QUOTE_LINK.findall(chunk):
+                link = int(link)
+                if link not in refs:
+                    refs.add(link)
+                    pending.add(link)
+    return refs, ahead
+
+
+def saved_messages(messages, result: pathlib.Path, chat_name):
+    # "messages", also written to "result" as converter.py --format jsonl --result would
+    # (without the chat id, which only converter.py is given)
+    from converter import order_message
+    compact = dict(ensure_ascii=False, separators=(',', ':'))
+    with result.open('w', encoding='utf-8') as f:
+        f.write(json.dumps({'name': chat_name, 'type': 'personal_chat', 'id': None}, **compact) + '\n')
+        for m in messages:
+            f.write(json.dumps(order_message(m), **compact) + '\n')
+            yield m
+
+
+def prepare_html_chat(path: pathlib.Path, only_n=math.inf, out=None, parser='html.parser', save_result=False):
+    # prepare_chat straight from the messages*.html, with converter.py's parser and no JSON in between
+    import converter
+    from merge import merge_messages
+    htmls = html_files(path)
+    index = {}
+    # merge_messages drops the messages repeated across pages, as merge.py does
+    messages = merge_messages([profiling.timed(converter.iter_export(path, parser), 'parse', 'messages')])
+    if save_result:
+        messages = saved_messages(messages, path / 'result.jsonl', converter.read_chat_name(htmls[0], parser))
+    messages = indexed(messages, *html_references(htmls), index)
+    filelist = {}
+    head = write_lines(iter_whatsapp_lines(islice(messages, _limit(only_n)), index, filelist), out)
+    if save_result:
+        # result.jsonl gets the whole chat, even with --only-first
+        for _ in messages:
+            pass
+    return head, filelist
+
+
+def imported_media(uf, info):
     fn = info['filename']
     mime = info.get('mime_type') or mimetypes.guess_type(fn)[0] or 'application/octet-stream'
-    uf = client.upload_file(path)
 
     # Video note (round message)
     if info.get('media_type') == 'video_message':
@@ -186,51 +368,513 @@ def upload_file(client, peer, imp_id, base_path, rel_path, info):
             attrs.append(types.DocumentAttributeAudio(info['duration_seconds']))
         media = types.InputMediaUploadedDocument(file=uf, mime_type=mime, attributes=attrs)
 
-    client(functions.messages.UploadImportedMediaRequest(peer=peer, import_id=imp_id, file_name=fn, media=media))
+    return media
+
+
+# Worth another try after a backoff (FloodWaits are handled on their own)
+TRANSIENT_ERRORS = (errors.ServerError, errors.TimedOutError, ConnectionError, asyncio.TimeoutError)
+
+
+class UploadScheduler:
+    # Files in flight (AIMD): one more per "limit" successes, halved on a FloodWait, a quarter less on errors
+    def __init__(self, max_limit=16, start=4, retries=5, backoff=1.0, max_backoff=60.0):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(max(1, min(start, self.max_limit)))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.queued = 0
+        self.flood_waits = 0
+        self.retried = 0
+        self.paused_until = 0.0
+        self._finished = deque()  # monotonic times of the last finished files
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        now = time.monotonic()
+        self._finished.append(now)
+        while self._finished and self._finished[0] < now - 60:
+            self._finished.popleft()
+
+    def _decrease(self, factor):
+        self.limit = max(1.0, self.limit * factor)
+
+    async def call(self, factory):
+        # await factory(), again after FloodWaits and transient errors
+        attempt = 0
+        while True:
+            # The pause may be extended while waiting
+            while (delay := self.paused_until - time.monotonic()) > 0:
+                # Jittered, so the waiting calls do not all hit the server at once
+                await asyncio.sleep(delay * random.uniform(1, 1.1))
+            try:
+                return await factory()
+            except errors.FloodError as e:
+                self.flood_waits += 1
+                profiling.count('flood_waits')
+                self._decrease(0.5)
+                self.paused_until = max(self.paused_until, time.monotonic() + (getattr(e, 'seconds', 0) or 1))
+            except TRANSIENT_ERRORS:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                self.retried += 1
+                profiling.count('retries')
+                self._decrease(0.75)
+                await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    @property
+    def rate(self):
+        # Files per second over the last minute
+        if len(self._finished) < 2:
+            return 0.0
+        span = time.monotonic() - self._finished[0]
+        return len(self._finished) / span if span > 0 else 0.0
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'rate': round(self.rate, 2),
+            'flood_waits': self.flood_waits,
+            'retries': self.retried,
+        }
+
+
+async def rpc(client, request):
+    # await client(request), its latency recorded with --profile
+    started = time.perf_counter()
+    try:
+        return await client(request)
+    finally:
+        profiling.observe(f'rpc.{type(request).__name__}', time.perf_counter() - started)
 
 
-def import_history(path: pathlib.Path, peer_id: str, test_only=False, only_first_n=math.inf):
-    json_file = path / 'result.json'
-    if not json_file.exists():
-        sys.exit('Not found result.json')
-    with open(json_file, encoding='utf-8') as f:
-        data = json.load(f)
+# Files over this are uploaded with SaveBigFilePart
+BIG_FILE = 10 * 1024 * 1024
+# Allowed part sizes in KB (512 KB must be a multiple of the part size)
+PART_SIZES_KB = (32, 64, 128, 256, 512)
 
-    messages, files = convert_json_to_whatsapp_format(data, only_first_n)
-    head = ''.join(messages[:100])
 
-    api_id, api_hash = ID, 'HASH'
-    with TelegramClient('telegram_import', api_id, api_hash) as client:
+def file_part_size(size, part_size):
+    # The part size used for a file of "size" bytes: big files get at least Telethon's,
+    # so they stay under Telegram's limit on the number of parts (FILE_PARTS_INVALID)
+    if size > BIG_FILE:
+        return max(part_size, utils.get_appropriated_part_size(size) * 1024)
+    return part_size
+
+
+async def for_each(items, parallel, fn):
+    # await fn(item) for every item, up to "parallel" at a time; the first error cancels the others
+    items = iter(items)
+
+    async def runner():
+        for item in items:
+            await fn(item)
+
+    runners = [asyncio.ensure_future(runner()) for _ in range(max(1, parallel))]
+    try:
+        await asyncio.gather(*runners)
+    except BaseException:
+        for r in runners:
+            r.cancel()
+        # Let them stop before the caller cleans up what they use
+        await asyncio.gather(*runners, return_exceptions=True)
+        raise
+
+
+async def upload_parts(client, path: pathlib.Path, part_size=512 * 1024, parallel=8, call=None):
+    # A file's parts, "parallel" requests in flight, each retried on its own and read from an mmap when sent
+    call = call or (lambda factory: factory())
+    size = path.stat().st_size
+    is_big = size > BIG_FILE
+    part_size = file_part_size(size, part_size)
+    total = max(1, math.ceil(size / part_size))
+    file_id = random.getrandbits(63)
+    md5 = ''
+
+    with open(path, 'rb') as f, (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else memoryview(b'')) as mm:
+        if not is_big:
+            md5 = hashlib.md5(mm).hexdigest()
+
+        async def send(part):
+            data = bytes(mm[part * part_size:(part + 1) * part_size])
+            if is_big:
+                request = functions.upload.SaveBigFilePartRequest(file_id, part, total, data)
+            else:
+                request = functions.upload.SaveFilePartRequest(file_id, part, data)
+            if not await call(lambda: rpc(client, request)):
+                raise ValueError(f'Failed to upload file part {part}')
+            profiling.count('upload.parts')
+            profiling.count('upload.bytes', len(data))
+
+        await for_each(range(total), min(parallel, total), send)
+    if is_big:
+        return types.InputFileBig(file_id, total, path.name)
+    return types.InputFile(file_id, total, path.name, md5)
+
+
+async def upload_file(client, peer, imp_id, base_path, rel_path, info, call=None, part_size=512 * 1024,
+                      part_parallel=8, copies=(), on_done=None):
+    # "call" wraps every request (UploadScheduler.call), by default just awaits it.
+    # "copies": (rel_path, info) of the files with the same content, imported with the same upload.
+    call = call or (lambda factory: factory())
+    uf = await upload_parts(client, base_path / rel_path, part_size, part_parallel, call)
+    profiling.count('upload.files')
+
+    async def send(item):
+        rel, file_info = item
+        media = imported_media(uf, file_info)
+        await call(lambda: rpc(client, functions.messages.UploadImportedMediaRequest(peer=peer, import_id=imp_id, file_name=file_info['filename'], media=media)))
+        if on_done is not None:
+            on_done(rel)
+
+    await send((rel_path, info))
+    # The copies only need their import request, sent "part_parallel" at a time
+    await for_each(copies, part_parallel, send)
+    profiling.count('upload.copies', len(copies))
+
+
+async def upload_all(client, peer, imp_id, base_path, files, concurrency=16, progress=None, on_done=None,
+                     scheduler=None, part_size=512 * 1024, part_parallel=8, copies=None):
+    # Upload the media as "scheduler" allows, each import request (and its copies) sent once its upload is done
+    if scheduler is None:
+        scheduler = UploadScheduler(concurrency)
+    copies = copies or {}
+    queue = deque(files.items())
+    scheduler.queued = len(queue)
+
+    def done(rel):
+        if on_done is not None:
+            on_done(rel)
+        if progress is not None:
+            progress.set_postfix(scheduler.stats(), refresh=False)
+            progress.update(1)
+
+    async def worker():
+        while queue:
+            rel, info = queue.popleft()
+            scheduler.queued = len(queue)
+            async with scheduler.slot():
+                await upload_file(client, peer, imp_id, base_path, rel, info, scheduler.call, part_size, part_parallel,
+                                  copies.get(rel, ()), done)
+                scheduler.success()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(scheduler.max_limit, len(files))))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for w in workers:
+            w.cancel()
+        raise
+
+
+class HashCache:
+    # Content hashes of the media (.import_hashes.json), reused while the size and mtime match
+    def __init__(self, path: pathlib.Path):
+        self.path = path / '.import_hashes.json'
+        self.dirty = False
         try:
-            peer = client.get_entity(types.PeerChannel(int(peer_id)))
-        except:
-            peer = peer_id
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def hash(self, base_path, rel_path):
+        st = (base_path / rel_path).stat()
+        entry = self.entries.get(rel_path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        from converter import file_hash
+        digest = file_hash(base_path / rel_path)
+        self.entries[rel_path] = [st.st_size, st.st_mtime_ns, digest]
+        self.dirty = True
+        return digest
+
+    def save(self):
+        if self.dirty:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            self.dirty = False
+
+
+def find_duplicates(base_path, files, sizes, cache):
+    # {first rel: [(rel, info), ...]} of the files with the same content (only same-size files are hashed)
+    by_size = defaultdict(list)
+    for rel in files:
+        if sizes[rel]:
+            by_size[sizes[rel]].append(rel)
+    copies = {}
+    for rels in by_size.values():
+        if len(rels) < 2:
+            continue
+        first = {}
+        for rel in rels:
+            try:
+                digest = cache.hash(base_path, rel)
+            except OSError:
+                continue
+            if digest in first:
+                copies.setdefault(first[digest], []).append((rel, files[rel]))
+            else:
+                first[digest] = rel
+    return copies
 
-        client(functions.messages.CheckHistoryImportRequest(import_head=head))
-        client(functions.messages.CheckHistoryImportPeerRequest(peer=peer))
 
-        tmp = tempfile.NamedTemporaryFile('w+t', delete=False, encoding='utf-8', prefix='imp_', suffix='.txt')
-        tmp.writelines(messages)
+def file_size(base_path, rel_path, info):
+    # file_size from result.json, else the file itself (0 if missing)
+    if info.get('file_size'):
+        return info['file_size']
+    try:
+        return (base_path / rel_path).stat().st_size
+    except OSError:
+        return 0
+
+
+def plan_uploads(base_path, files):
+    # The files largest first, so no big video uploads alone at the end, and their sizes
+    sizes = {rel: file_size(base_path, rel, info) for rel, info in files.items()}
+    order = sorted(files, key=lambda rel: -sizes[rel])
+    return {rel: files[rel] for rel in order}, sizes
+
+
+def upload_seconds(size, rtt, bytes_per_s, part_size=512 * 1024, part_parallel=8):
+    # One file: its parts "part_parallel" at a time, each a round trip plus its transfer, then the import request
+    part_size = file_part_size(size, part_size)
+    parts = max(1, math.ceil(size / part_size))
+    waves = math.ceil(parts / max(1, part_parallel))
+    return (waves + 1) * rtt + waves * min(size, part_size) / bytes_per_s
+
+
+def measure_rate(size, seconds, rtt):
+    # bytes/s of one upload of "size" that took "seconds", without its round trips
+    # (None if it was too small for the transfer to show)
+    parts = max(1, math.ceil(size / (utils.get_appropriated_part_size(size) * 1024)))
+    transfer = seconds - parts * rtt
+    if transfer < parts * rtt / 2:
+        return None
+    return size / transfer
+
+
+def estimate_upload_time(sizes, concurrency, rtt, bytes_per_s, part_size=512 * 1024, part_parallel=8):
+    # Seconds to upload "sizes" in this order, "concurrency" at a time, at the rate of one upload
+    ends = [0.0] * max(1, min(concurrency, len(sizes)))
+    for size in sizes:
+        heapq.heappush(ends, heapq.heappop(ends) + upload_seconds(size, rtt, bytes_per_s, part_size, part_parallel))
+    return max(ends)
+
+
+def chat_file(path: pathlib.Path):
+    # result.json (indented or compact), or result.jsonl from converter.py --format jsonl
+    for name in ('result.json', 'result.jsonl'):
+        if (path / name).exists():
+            return path / name
+    sys.exit('Not found result.json')
+
+
+class ImportJournal:
+    # import_journal.jsonl for --resume: a header line, then a synced line per imported media file
+    def __init__(self, path: pathlib.Path):
+        self.path = path / 'import_journal.jsonl'
+        self.header = None
+        self.done = set()
+
+    def load(self):
+        if not self.path.exists():
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if self.header is None:
+                    self.header = entry
+                else:
+                    self.done.add(entry['done'])
+        return self.header
+
+    def start(self, header):
+        self.header = header
+        self.done = set()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._f = open(self.path, 'a', encoding='utf-8')
+
+    def resume(self):
+        self._f = open(self.path, 'a', encoding='utf-8')
+
+    def mark(self, rel):
+        self.done.add(rel)
+        self._f.write(json.dumps({'done': rel}, ensure_ascii=False) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def finish(self):
+        self._f.close()
+        self.path.unlink()
+
+
+def chat_identity(path: pathlib.Path, only_first_n, html=False):
+    # What the journal's filelist was built from: a resume must see the same
+    files = html_files(path) if html else [chat_file(path)]
+    stats = [f.stat() for f in files]
+    return {
+        'chat_file': 'messages*.html' if html else files[0].name,
+        'size': sum(st.st_size for st in stats),
+        'mtime_ns': max(st.st_mtime_ns for st in stats),
+        'only_first': only_first_n if math.isfinite(only_first_n) else None,
+    }
+
+
+async def run_import(client, path: pathlib.Path, peer_id: str, test_only=False, only_first_n=math.inf,
+                     concurrency=16, resume=False, part_size=512 * 1024, part_parallel=8, dedup=True, html=False,
+                     parser='html.parser', save_result=False):
+    # The import text is only uploaded by a new import, --resume just needs the media list
+    tmp = None if resume else tempfile.NamedTemporaryFile('w+t', delete=False, encoding='utf-8', prefix='imp_', suffix='.txt')
+    with profiling.stage('prepare_text'):
+        if html:
+            head, files = prepare_html_chat(path, only_first_n, tmp, parser, save_result and not resume)
+        else:
+            head, files = prepare_chat(path, only_first_n, tmp)
+    head = ''.join(head)
+    if tmp is not None:
         tmp.close()
+    journal = ImportJournal(path)
+    identity = chat_identity(path, only_first_n, html)
 
-        up = client.upload_file(tmp.name)
-        history = client(functions.messages.InitHistoryImportRequest(peer=peer, file=up, media_count=len(files)))
+    try:
+        peer = await client.get_entity(types.PeerChannel(int(peer_id)))
+    except:
+        peer = peer_id
+
+    rtt = bytes_per_s = None
+    if resume:
+        header = journal.load()
+        if header is None:
+            sys.exit(f'Nothing to resume: {journal.path.name} not found')
+        if header['peer'] != peer_id or header['chat'] != identity:
+            sys.exit(f'{journal.path.name} is for another import (peer {header["peer"]}, {header["chat"]["chat_file"]})')
+        import_id = header['import_id']
+        rtt, bytes_per_s = header.get('rtt'), header.get('bytes_per_s')
+        journal.resume()
+        print(f'Resuming import {import_id}: {len(journal.done & files.keys())} of {len(files)} files already uploaded')
+    else:
+        await rpc(client, functions.messages.CheckHistoryImportRequest(import_head=head))
+        started = time.perf_counter()
+        await rpc(client, functions.messages.CheckHistoryImportPeerRequest(peer=peer))
+        rtt = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with profiling.stage('upload_text'):
+            up = await client.upload_file(tmp.name)
+        bytes_per_s = measure_rate(os.path.getsize(tmp.name), time.perf_counter() - started, rtt)
+        profiling.count('upload.text_bytes', os.path.getsize(tmp.name))
+        history = await rpc(client, functions.messages.InitHistoryImportRequest(peer=peer, file=up, media_count=len(files)))
         os.remove(tmp.name)
+        import_id = history.id
+        journal.start({'import_id': import_id, 'peer': peer_id, 'chat': identity, 'rtt': rtt, 'bytes_per_s': bytes_per_s})
+
+    pending, sizes = plan_uploads(path, {rel: info for rel, info in files.items() if rel not in journal.done})
+    copies = {}
+    if dedup:
+        with profiling.stage('dedup'):
+            hashes = HashCache(path)
+            copies = find_duplicates(path, pending, sizes, hashes)
+            hashes.save()
+    copied = {rel for group in copies.values() for rel, _ in group}
+    unique = {rel: info for rel, info in pending.items() if rel not in copied}
+    if pending:
+        summary = f'{len(pending)} media files, {sum(sizes.values()) / 1e6:.1f} MB'
+        if copied:
+            summary += (f' ({len(copied)} copies of other files, {sum(sizes[rel] for rel in copied) / 1e6:.1f} MB,'
+                        f' are not uploaded again)')
+        if bytes_per_s:
+            estimate = estimate_upload_time([sizes[rel] for rel in unique], concurrency, rtt, bytes_per_s,
+                                            part_size, part_parallel)
+            summary += (f': about {time.strftime("%H:%M:%S", time.gmtime(estimate))} at {bytes_per_s / 1e6:.2f} MB/s'
+                        f' per upload, {rtt * 1000:.0f} ms round trip, up to {concurrency} at a time')
+        print(summary)
+    # FloodWaits are left to UploadScheduler instead of Telethon's blind sleep
+    client.flood_sleep_threshold = 0
+    with tqdm(total=len(files), initial=len(files) - len(pending), desc='Uploading media') as progress, \
+            profiling.stage('upload_media'):
+        await upload_all(client, peer, import_id, path, unique, concurrency, progress, journal.mark,
+                         part_size=part_size, part_parallel=part_parallel, copies=copies)
+
+    if test_only:
+        journal.finish()
+        print('The test mode has ended')
+        return
+    await rpc(client, functions.messages.StartHistoryImportRequest(peer=peer, import_id=import_id))
+    journal.finish()
+
+
+async def import_history_async(path: pathlib.Path, peer_id: str, test_only=False, only_first_n=math.inf,
+                               concurrency=16, resume=False, part_size=512 * 1024, part_parallel=8, dedup=True,
+                               html=False, parser='html.parser', save_result=False):
+    api_id, api_hash = ID, 'HASH'
+    async with TelegramClient('telegram_import', api_id, api_hash) as client:
+        await run_import(client, path, peer_id, test_only, only_first_n, concurrency, resume, part_size, part_parallel,
+                         dedup, html, parser, save_result)
 
-        for rel, info in tqdm(files.items(), desc='Uploading media'):
-            upload_file(client, peer, history.id, path, rel, info)
 
-        if test_only:
-            print('The test mode has ended')
-            return
-        client(functions.messages.StartHistoryImportRequest(peer=peer, import_id=history.id))
+def import_history(path: pathlib.Path, peer_id: str, test_only=False, only_first_n=math.inf, concurrency=16,
+                   resume=False, part_size=512 * 1024, part_parallel=8, dedup=True, html=False, parser='html.parser',
+                   save_result=False):
+    asyncio.run(import_history_async(path, peer_id, test_only, only_first_n, concurrency, resume, part_size,
+                                     part_parallel, dedup, html, parser, save_result))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import JSON chat into Telegram')
-    parser.add_argument('--path', required=True, help='The path to the folder with result.json')
+    parser.add_argument('--path', required=True, help='The path to the folder with result.json (or result.jsonl)')
     parser.add_argument('--peer', required=True, help='Chat-ID or @username')
     parser.add_argument('--test-only', action='store_true', help='Test mode only')
     parser.add_argument('--only-first', type=float, help='First N messages')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Most media files uploaded at the same time (starts at 4, adapts to FloodWaits)')
+    parser.add_argument('--part-size', type=int, choices=PART_SIZES_KB, default=512, help='Upload part size in KB')
+    parser.add_argument('--part-parallel', type=int, default=8,
+                        help='Parts of a media file uploaded at the same time (1 = one by one, as Telethon does)')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Upload every media file, even those with the same content as another one')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the interrupted import of import_journal.jsonl: upload only the missing media')
+    parser.add_argument('--html', action='store_true',
+                        help='Read the messages*.html of the export directly (converter.py next to import.py), '
+                             'instead of result.json')
+    parser.add_argument('--parser', choices=('html.parser', 'lxml'), default='html.parser',
+                        help='HTML parser backend for --html (lxml is much faster)')
+    parser.add_argument('--save-result', action='store_true',
+                        help='With --html, also write the parsed messages to result.jsonl')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='Write the time of every stage, the request latencies and the bytes uploaded to this JSON file')
+    parser.add_argument('--cprofile', metavar='FILE', help='With --profile, also write a cProfile dump (pstats) to FILE')
     args = parser.parse_args()
-    import_history(pathlib.Path(args.path), args.peer, args.test_only, args.only_first or math.inf)
+    if args.profile:
+        profiling.start(args.profile, args.cprofile)
+    try:
+        import_history(pathlib.Path(args.path), args.peer, args.test_only, args.only_first or math.inf,
+                       args.concurrency, args.resume, args.part_size * 1024, args.part_parallel, not args.no_dedup,
+                       args.html, args.parser, args.save_result)
+    finally:
+        # Also after an error: the report shows where it stopped
+        profiling.finish()
@@ -1,43 +1,202 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
 import json
 import pathlib
+import re
+import sys
+try:
+    import stage_profile as profiling
+except ImportError:
+    sys.exit("stage_profile.py must be next to merge.py")
 
-# Folder with json files
-FOLDER = pathlib.Path("YOUR_PATH")  # for example, FOLDER = pathlib.Path("C:/Users/YourName/ChatExport_2025-05-23")
-OUTFILE = FOLDER / "result.json"
-
-# List of files in order
-files = [FOLDER / "messages.json"] + [FOLDER / f"messages{i}.json" for i in range(2, 132)]
-
-all_messages = []
-meta = None
-
-for idx, file in enumerate(files):
-    if not file.exists():
-        print(f"Missed: {file}")
-        continue
-    with open(file, encoding="utf-8") as f:
-        data = json.load(f)
-        # Support for both formats (list or object with key messages)
-        if isinstance(data, dict) and "messages" in data:
-            msgs = data["messages"]
-            # Copy the "header" (metadata) only from the first file
-            if meta is None:
-                meta = {k: v for k, v in data.items() if k != "messages"}
-        elif isinstance(data, list):
-            msgs = data
-        else:
-            print(f"Unknown file format: {file}")
+# Output formats of converter.py and merge.py: "pretty" is json.dump(..., indent=4)
+# of the whole chat, "compact" the same object without whitespace, "jsonl" a line
+# with the chat header then one line per message
+FORMATS = {"pretty": ".json", "compact": ".json", "jsonl": ".jsonl"}
+
+def natural_key(path: pathlib.Path):
+    # messages.html/.json, messages2, ..., messages10 (not messages10 before messages2);
+    # converter.py sorts the html pages with it too
+    m = re.search(r"(\d+)$", path.stem)
+    return (int(m.group(1)) if m else 0, path.name)
+
+def discover(folder: pathlib.Path):
+    files = [p for p in folder.glob("messages*.json*") if p.suffix in (".json", ".jsonl")]
+    return sorted(files, key=natural_key)
+
+class JsonReader:
+    # Reads a JSON document value by value, one block of the file at a time
+    def __init__(self, f, block_size: int = 1 << 16):
+        self.f = f
+        self.block_size = block_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        block = self.f.read(self.block_size)
+        if not block:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+
+    def peek(self):
+        # Next non-whitespace character ("" at the end of the file)
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} at {self.buf[self.pos:self.pos + 40]!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may go on in the next block
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def read_messages(path: pathlib.Path, header: dict):
+    # The messages of a converter output (json, compact or jsonl) one by one, the other keys in "header"
+    with path.open(encoding="utf-8") as f:
+        if path.suffix == ".jsonl":
+            first = json.loads(f.readline() or "{}")
+            if "type" in first and "id" in first and "date" not in first:
+                header.update(first)
+            else:
+                yield first
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        reader = JsonReader(f)
+        if reader.peek() == "{":
+            reader.expect("{")
+            while reader.peek() != "}":
+                key = reader.value()
+                reader.expect(":")
+                if key == "messages":
+                    break
+                header[key] = reader.value()
+                if reader.peek() == ",":
+                    reader.expect(",")
+            else:
+                return
+        reader.expect("[")
+        while reader.peek() != "]":
+            yield reader.value()
+            if reader.peek() == ",":
+                reader.expect(",")
+
+def sort_key(by: str):
+    if by == "date":
+        return lambda m: (int(m.get("date_unixtime") or 0), m.get("id", 0))
+    return lambda m: (m.get("id", 0), int(m.get("date_unixtime") or 0))
+
+def merge_messages(streams, by: str = "id", stats: dict = None):
+    # k-way merge of sorted message streams without duplicate ids (ids <= 0 never are)
+    key = sort_key(by)
+    last = None
+    for msg in heapq.merge(*streams, key=key):
+        k = key(msg)
+        if k == last and msg.get("id", 0) > 0:
+            if stats is not None:
+                stats["duplicates"] = stats.get("duplicates", 0) + 1
             continue
-        all_messages.extend(msgs)
+        last = k
+        yield msg
+
+def write_chat(output_file: pathlib.Path, header: dict, messages, fmt: str = "pretty"):
+    # Same text as json.dump(chat, indent=2), but written message by message
+    count = 0
+    compact = dict(ensure_ascii=False, separators=(",", ":"))
+    with output_file.open("w", encoding="utf-8") as f:
+        if fmt == "jsonl":
+            f.write(json.dumps(header, **compact) + "\n")
+            for msg in messages:
+                f.write(json.dumps(msg, **compact) + "\n")
+                count += 1
+            return count
+        if fmt == "compact":
+            text = json.dumps(header, **compact)
+            f.write((text[:-1] + "," if header else "{") + '"messages":[')
+            for msg in messages:
+                f.write(("," if count else "") + json.dumps(msg, **compact))
+                count += 1
+            f.write("]}")
+            return count
+        text = json.dumps(header, ensure_ascii=False, indent=2)
+        f.write((text[:-2] + ",\n" if header else "{\n") + '  "messages": [')
+        sep = "\n    "
+        for msg in messages:
+            f.write(("," if count else "") + sep + json.dumps(msg, ensure_ascii=False, indent=2).replace("\n", sep))
+            count += 1
+        f.write("\n  ]\n}" if count else "]\n}")
+    return count
+
+def _chain(first, rest):
+    if first is not None:
+        yield first
+    yield from rest
+
+def merge_files(files, output: pathlib.Path, by: str = "id", fmt: str = "pretty"):
+    # Merge the message files into "output": (messages written, duplicates dropped)
+    # The header (metadata) is taken from the first file that has one
+    headers = [{} for _ in files]
+    streams = [profiling.timed(read_messages(file, h), "read_json", "messages_read") for file, h in zip(files, headers)]
+    # Start every stream, so the headers are read before anything is written
+    firsts = [next(s, None) for s in streams]
+    header = next((h for h in headers if h), {})
+    streams = [_chain(first, s) for first, s in zip(firsts, streams)]
+    stats = {}
+    with profiling.stage("write_json"):
+        count = write_chat(output, header, merge_messages(streams, by, stats), fmt)
+    profiling.count("messages_written", count)
+    profiling.count("duplicates", stats.get("duplicates", 0))
+    return count, stats.get("duplicates", 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge messages*.json files into result.json")
+    parser.add_argument("--path", required=True, help="Folder with the messages*.json files")
+    parser.add_argument("--output", help="Output file (default: result.json in that folder)")
+    parser.add_argument("--by", choices=("id", "date"), default="id",
+                        help="Order of the merged messages: by id, or by date_unixtime then id")
+    parser.add_argument("--format", choices=FORMATS, default="pretty",
+                        help="Output: indented json (pretty), json without whitespace (compact) or jsonl")
+    parser.add_argument("--profile", metavar="REPORT", help="Write the reading and writing time and counters to this JSON file")
+    parser.add_argument("--cprofile", metavar="FILE", help="With --profile, also write a cProfile dump (pstats) to FILE")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.start(args.profile, args.cprofile)
+
+    folder = pathlib.Path(args.path)
+    files = discover(folder)
+    if not files:
+        sys.exit(f"No messages*.json files in {folder}")
+    output = pathlib.Path(args.output) if args.output else folder / ("result" + FORMATS[args.format])
 
-# Combine everything into a single object with metadata and messages
-if meta is None:
-    meta = {}
-result = meta.copy()
-result["messages"] = all_messages
+    count, duplicates = merge_files(files, output, args.by, args.format)
 
-with open(OUTFILE, "w", encoding="utf-8") as f:
-    json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Files: {len(files)} ({files[0].name} ... {files[-1].name})")
+    if duplicates:
+        print(f"Duplicates dropped: {duplicates}")
+    print(f"✅ Merging completed! Total messages: {count}")
+    print(f"Final file: {output}")
+    profiling.finish({"files": len(files)})
 
-print(f"✅ Merging completed! Total messages: {len(all_messages)}")
-print(f"Final file: {OUTFILE}")
+if __name__ == "__main__":
+    main()
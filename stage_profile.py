@@ -0,0 +1,206 @@
+"""Stage timers, counters and latency histograms for converter.py, merge.py and import.py.
+
+Off unless a script is run with --profile REPORT.json: then start() turns
+it on and finish() writes the report (and a cProfile dump with
+--cprofile FILE). While off, stage() returns a shared no-op context,
+timed() returns its iterable unchanged and count() / observe() return
+at once, so the instrumented code pays one function call per page, media
+file or request.
+
+A stage's "seconds" include the stages run inside it (on the same
+thread), "self_s" does not. Stages of the --jobs workers and probe threads
+are added up, so their seconds may exceed the wall time.
+"""
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+enabled = False
+stages = {}          # name -> [calls, seconds, seconds of the stages inside]
+counters = Counter()
+histograms = {}      # name -> {bucket: count}, buckets are powers of 2 of a millisecond
+_sums = {}           # name -> [count, total, min, max]
+_lock = threading.Lock()
+_local = threading.local()
+_started = None
+_report = None
+_profiler = None
+_dump = None
+
+NULL_STAGE = nullcontext()
+
+class _Stage:
+    __slots__ = ("name", "start", "children")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        stack.append(self)
+        self.children = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        with _lock:
+            entry = stages.setdefault(self.name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += self.children
+        return False
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def stage(name: str):
+    # with stage("parse"): ...
+    return _Stage(name) if enabled else NULL_STAGE
+
+def timed(iterable, name: str, counter: str = None):
+    # The time spent producing the items of "iterable" (a generator doing the work
+    # lazily), the items counted in "counter"
+    if not enabled:
+        return iterable
+    return _timed(iter(iterable), name, counter)
+
+def _timed(it, name, counter):
+    n = 0
+    try:
+        while True:
+            with _Stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            n += 1
+            yield item
+    finally:
+        if counter:
+            count(counter, n)
+
+def count(name: str, n=1):
+    if enabled:
+        with _lock:
+            counters[name] += n
+
+def observe(name: str, seconds: float):
+    # One latency sample, for the histogram of "name"
+    if not enabled:
+        return
+    bucket = 2 ** max(0, math.ceil(math.log2(max(seconds * 1000, 1e-9))))
+    with _lock:
+        hist = histograms.setdefault(name, {})
+        hist[bucket] = hist.get(bucket, 0) + 1
+        s = _sums.get(name)
+        if s is None:
+            _sums[name] = [1, seconds, seconds, seconds]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            s[2] = min(s[2], seconds)
+            s[3] = max(s[3], seconds)
+
+def snapshot():
+    # Everything measured so far, to be merged into another process's report
+    with _lock:
+        return {"stages": {k: list(v) for k, v in stages.items()}, "counters": dict(counters),
+                "histograms": {k: dict(v) for k, v in histograms.items()}, "sums": {k: list(v) for k, v in _sums.items()}}
+
+def clear():
+    with _lock:
+        stages.clear()
+        counters.clear()
+        histograms.clear()
+        _sums.clear()
+
+def merge(snap: dict):
+    with _lock:
+        for name, (calls, seconds, children) in snap["stages"].items():
+            entry = stages.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += children
+        counters.update(snap["counters"])
+        for name, hist in snap["histograms"].items():
+            mine = histograms.setdefault(name, {})
+            for bucket, n in hist.items():
+                mine[bucket] = mine.get(bucket, 0) + n
+        for name, (n, total, lo, hi) in snap["sums"].items():
+            s = _sums.setdefault(name, [0, 0.0, lo, hi])
+            s[0] += n
+            s[1] += total
+            s[2] = min(s[2], lo)
+            s[3] = max(s[3], hi)
+
+def start(report, cprofile=None):
+    # Turn the instrumentation on; finish() writes "report" (JSON) and "cprofile" (pstats)
+    global enabled, _started, _report, _profiler, _dump
+    enabled = True
+    _started = time.perf_counter()
+    _report, _dump = report, cprofile
+    if cprofile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def _percentile(hist: dict, q: float):
+    # Upper bound (ms) of the bucket holding the q-th sample
+    total = sum(hist.values())
+    seen = 0
+    for bucket in sorted(hist):
+        seen += hist[bucket]
+        if seen >= q * total:
+            return bucket
+    return None
+
+def report(extra: dict = None):
+    wall = time.perf_counter() - _started if _started is not None else 0.0
+    data = {
+        "script": os.path.basename(sys.argv[0]),
+        "argv": sys.argv[1:],
+        "wall_s": round(wall, 4),
+        "stages": {name: {"calls": calls, "seconds": round(seconds, 4), "self_s": round(seconds - children, 4)}
+                   for name, (calls, seconds, children) in sorted(stages.items(), key=lambda kv: -kv[1][1])},
+        "counters": dict(sorted(counters.items())),
+        "per_s": {name: round(n / wall, 2) for name, n in sorted(counters.items())} if wall else {},
+        "latency_ms": {},
+    }
+    for name, hist in sorted(histograms.items()):
+        n, total, lo, hi = _sums[name]
+        data["latency_ms"][name] = {
+            "count": n, "mean": round(total / n * 1000, 2), "min": round(lo * 1000, 2), "max": round(hi * 1000, 2),
+            "p50": _percentile(hist, 0.5), "p90": _percentile(hist, 0.9), "p99": _percentile(hist, 0.99),
+            "buckets": {f"<={b}": hist[b] for b in sorted(hist)},
+        }
+    if extra:
+        data.update(extra)
+    return data
+
+def finish(extra: dict = None):
+    # Writes the report (and the cProfile dump) if start() was called
+    global enabled, _profiler
+    if not enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_dump)
+        _profiler = None
+    data = report(extra)
+    with open(_report, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    enabled = False
+    print(f"Profile: {_report} ({data['wall_s']:.1f} s)")